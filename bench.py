@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import logging
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+import experiment
+import extract
+import sim
+
+# Constants
+SPEEDUP = 60.0
+SCALE = 1.0
+ROUND_TRIPS = ["http", "sql", "ssh", "sftp"]
+REPEATS = 3
+REGRESSION_TOLERANCE = 0.2
+REGRESSION_MIN_SECONDS = 0.5  # faster stages are too noisy to gate on throughput
+
+# Get logger
+log = logging.getLogger("fluffi")
+
+
+def main():
+    # Setup logging
+    log.setLevel(logging.WARNING)
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("suite", type=str, help="orchestration or extract")
+    parser.add_argument("-s", type=float, default=SPEEDUP, help="simulated CPU speedup")
+    parser.add_argument(
+        "-x", type=float, default=SCALE, help="synthetic dump scale (1 is ~20 MB)"
+    )
+    parser.add_argument(
+        "-r", type=int, default=REPEATS, help="extract runs, the fastest is kept"
+    )
+    parser.add_argument("-o", type=str, help="CSV file to save results to")
+    parser.add_argument("-b", type=str, help="CSV file of baseline extract results")
+    args = parser.parse_args()
+
+    # Run the suite
+    if args.suite == "orchestration":
+        df = bench_orchestration(args.s)
+    elif args.suite == "extract":
+        df = bench_extract(args.x, args.r)
+    else:
+        print("Invalid suite")
+        exit(1)
+    print(df.to_string(index=False))
+    if args.o is not None:
+        df.to_csv(args.o, index=False)
+
+    # Compare against the baseline
+    if args.b is not None:
+        df_baseline = pd.read_csv(args.b).set_index("stage")
+        regressions = []
+        for row in df.to_dict("records"):
+            if row["stage"] not in df_baseline.index:
+                continue
+            baseline = df_baseline.loc[row["stage"]]
+            if baseline["seconds"] >= REGRESSION_MIN_SECONDS and row[
+                "rows_per_sec"
+            ] < baseline["rows_per_sec"] * (1 - REGRESSION_TOLERANCE):
+                regressions.append(f"{row['stage']} rows/sec")
+            if row["peak_rss_mb"] > baseline["peak_rss_mb"] * (
+                1 + REGRESSION_TOLERANCE
+            ):
+                regressions.append(f"{row['stage']} peak RSS")
+        if len(regressions) > 0:
+            print(f"Regressions: {', '.join(regressions)}")
+            exit(1)
+
+
+# Times each orchestration step against a simulated location
+def bench_orchestration(speedup):
+    inst = sim.Instance(speedup=speedup)
+    up_args = ["bench", "fuzzgoat/fuzzgoat", ("fuzzgoat", b""), [("seed", b"")]]
+    results = []
+
+    def measure(name, func):
+        round_trips = inst.sim.round_trips.copy()
+        start = time.time()
+        result = func()
+        row = {"op": name, "wall_time": time.time() - start}
+        for key in ROUND_TRIPS:
+            row[key] = inst.sim.round_trips[key] - round_trips[key]
+        results.append(row)
+        return result
+
+    # Single operations
+    fuzzjob = measure("up", lambda: inst.up(*up_args))
+    measure("get_cpu_time", fuzzjob.get_cpu_time)
+    measure("get_stats", fuzzjob.get_stats)
+    measure("down", inst.down)
+
+    # Full trial at the simulated speed
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        def trial():
+            fuzzjob = inst.up(*up_args)
+            stats = experiment.StatsWriter(os.path.join(tmp_dir, "01.arrow"))
+            experiment.collect_stats(fuzzjob, stats, "bench")
+            inst.down()
+            fuzzjob.get_dump(os.path.join(tmp_dir, "01.sql.gz"))
+            stats.close(os.path.join(tmp_dir, "01.parquet"))
+
+        measure("trial", trial)
+
+    inst.sim.close()
+    return pd.DataFrame(results)
+
+
+# Times each extract stage on a synthetic trial, keeping each stage's fastest of
+# the runs, with the peak RSS reset before each stage
+def bench_extract(scale, repeats=REPEATS):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rows = sim.write_synthetic_trial(tmp_dir, "01", scale)
+        results = []
+        for _ in range(repeats):
+            results += run_extract(tmp_dir, sum(rows.values()))
+    df = pd.DataFrame(results)
+    df = df.loc[df.groupby("stage", sort=False)["seconds"].idxmin()]
+    return df.reset_index(drop=True)
+
+
+def run_extract(tmp_dir, dump_rows):
+    dump_path = os.path.join(tmp_dir, experiment.DUMP_FMT.format("01"))
+    data_path = os.path.join(tmp_dir, experiment.DATA_FMT.format("01"))
+    labels = {
+        "experiment": extract.EXPERIMENTS[0],
+        "benchmark": experiment.BENCHMARKS[0],
+        "trial": 1,
+    }
+    results = []
+
+    def measure(name, func, get_rows, get_size):
+        reset_peak_rss()
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        rows = get_rows(result)
+        results.append(
+            {
+                "stage": name,
+                "rows": rows,
+                "seconds": seconds,
+                "rows_per_sec": rows / seconds,
+                "peak_rss_mb": get_peak_rss(),
+                "output_mb": get_size(result) / 2**20,
+            }
+        )
+        return result
+
+    def write(dfs):
+        size = 0
+        for i, df in enumerate(dfs):
+            path = os.path.join(tmp_dir, f"out{i}.parquet")
+            df.to_parquet(path)
+            size += os.path.getsize(path)
+        return size
+
+    def memory(dfs):
+        return sum(df.memory_usage(deep=True).sum() for df in dfs)
+
+    dump = measure(
+        "decompress",
+        lambda: extract.read_dump(dump_path),
+        lambda _: dump_rows,
+        len,
+    )
+    dfs = measure(
+        "parse",
+        lambda: extract.parse_dump(dump),
+        lambda dfs: sum(map(len, dfs)),
+        memory,
+    )
+    dump = None
+    df_covered_blocks, df_paths, df_crashes = dfs
+    dfs = measure(
+        "dedup",
+        lambda: (
+            extract.dedup_covered_blocks(df_covered_blocks),
+            df_paths,
+            extract.dedup_crashes(df_crashes),
+        ),
+        lambda _: len(df_covered_blocks) + len(df_crashes),
+        memory,
+    )
+    measure("write", lambda: write(dfs), lambda _: sum(map(len, dfs)), int)
+    df_measurements = measure(
+        "measurements",
+        lambda: pd.read_parquet(data_path),
+        len,
+        lambda _: os.path.getsize(data_path),
+    )
+
+    # Trial-level stages run on the labelled frames, as in extract.main
+    df_covered_blocks, df_paths, df_crashes = [df.assign(**labels) for df in dfs]
+    df_measurements = df_measurements.assign(**labels)
+    dfs = None
+    measure(
+        "block_cpu_times",
+        lambda: extract.block_cpu_times(df_covered_blocks, df_measurements),
+        len,
+        lambda cpu_times: cpu_times.nbytes,
+    )
+    measure(
+        "coverage_bitsets",
+        lambda: extract.coverage_bitsets(df_covered_blocks),
+        lambda _: len(df_covered_blocks),
+        lambda dfs: dfs[0]["offset"].nbytes + dfs[1]["bits"].map(len).sum(),
+    )
+    measure(
+        "encode_paths",
+        lambda: extract.encode_paths(df_paths),
+        lambda _: len(df_paths),
+        memory,
+    )
+    measure(
+        "crash_index",
+        lambda: extract.crash_index(df_crashes),
+        lambda _: len(df_crashes),
+        memory,
+    )
+    return results
+
+
+# Peak RSS is reset through clear_refs so each stage's peak is its own, though it
+# still includes the stage's inputs that are held in memory
+def reset_peak_rss():
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def get_peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+import pandas as pd
+
+# Constants
+LOAD_HIGH = 15.8
+LOAD_LOW = 14.3
+LOAD_COUNTER_MIN = 6
+THROUGHPUT_WINDOW = 3  # stats samples per measurement
+THROUGHPUT_HYSTERESIS = 0.03  # 3% improvement needed to keep a move
+MOVES = [("run", 1), ("eva", 1), ("run", -1), ("eva", -1), ("gen", 1), ("gen", -1)]
+BOUNDS = {"gen": (1, 4), "run": (1, 30), "eva": (1, 30)}
+AGENTS_MAX = 40
+
+# Get logger
+log = logging.getLogger("fluffi")
+
+
+def new(name):
+    if name is None:
+        return None
+    elif name == "load":
+        return LoadController()
+    elif name == "throughput":
+        return ThroughputController()
+    raise ValueError(f"Unknown controller {name}")
+
+
+# Moves runners and evaluators by one after the load stays out of range
+class LoadController:
+    sample = "load"
+
+    def __init__(self):
+        self.load_high_counter = 0
+        self.load_low_counter = 0
+
+    def reset(self):
+        self.load_high_counter = 0
+        self.load_low_counter = 0
+
+    def decide(self, gre, sample):
+        gen, run, eva = gre
+        load = sample["load"]
+        if load > LOAD_HIGH:
+            self.load_high_counter += 1
+            self.load_low_counter = 0
+            if self.load_high_counter >= LOAD_COUNTER_MIN:
+                log.warn(f"Decreasing RE agents to {run - 1} with load {load}")
+                self.load_high_counter = 0
+                return gen, run - 1, eva - 1
+        elif load < LOAD_LOW:
+            self.load_high_counter = 0
+            self.load_low_counter += 1
+            if self.load_low_counter >= LOAD_COUNTER_MIN:
+                log.warn(f"Increasing RE agents to {run + 1} with load {load}")
+                self.load_low_counter = 0
+                return gen, run + 1, eva + 1
+        else:
+            self.reset()
+        return gre
+
+
+# Hill climbs the GRE split on completed testcases per CPU second, keeping a
+# move only if it beats the measurement before it by THROUGHPUT_HYSTERESIS
+class ThroughputController:
+    sample = "stats"
+
+    def __init__(self):
+        self.window = []
+        self.best = None
+        self.trial = None
+        self.move_index = 0
+
+    def reset(self):
+        self.window = []
+
+    def decide(self, gre, sample):
+        # Measure throughput over a window of stats samples
+        self.window.append((sample["cpu_time"], sample["completed_testcases"]))
+        if len(self.window) <= THROUGHPUT_WINDOW:
+            return gre
+        (cpu_time_start, testcases_start), (cpu_time, testcases) = (
+            self.window[0],
+            self.window[-1],
+        )
+        self.window = []
+        if cpu_time <= cpu_time_start:
+            return gre
+        throughput = (testcases - testcases_start) / (cpu_time - cpu_time_start)
+
+        # Judge the move being tried
+        if self.trial is not None:
+            gre_prev, move = self.trial
+            self.trial = None
+            if throughput > self.best * (1 + THROUGHPUT_HYSTERESIS):
+                log.info(
+                    f"Keeping GRE {gre} with {throughput:.2f} testcases/s "
+                    f"over {self.best:.2f} testcases/s"
+                )
+            else:
+                log.info(
+                    f"Reverting GRE {gre} to {gre_prev} with {throughput:.2f} "
+                    f"testcases/s against {self.best:.2f} testcases/s"
+                )
+                self.move_index = (self.move_index + 1) % len(MOVES)
+                self.best = None
+                return gre_prev
+        self.best = throughput
+
+        # Try the next move within bounds
+        for _ in range(len(MOVES)):
+            move = MOVES[self.move_index]
+            gre_next = apply_move(gre, move)
+            if gre_next is not None:
+                log.info(
+                    f"Trying GRE {gre_next} from {gre} with {throughput:.2f} "
+                    "testcases/s"
+                )
+                self.trial = (gre, move)
+                return gre_next
+            self.move_index = (self.move_index + 1) % len(MOVES)
+        return gre
+
+
+def apply_move(gre, move):
+    role, delta = move
+    counts = dict(zip(["gen", "run", "eva"], gre))
+    counts[role] += delta
+    low, high = BOUNDS[role]
+    if counts[role] < low or counts[role] > high or sum(counts.values()) > AGENTS_MAX:
+        return None
+    return counts["gen"], counts["run"], counts["eva"]
+
+
+# Runs a controller over recorded stats and returns its decisions
+def replay(df, controller, gre):
+    decisions = []
+    for sample in df.sort_values("cpu_time").to_dict("records"):
+        gre_next = controller.decide(gre, sample)
+        if gre_next != gre:
+            decisions.append(
+                {
+                    "cpu_time": sample["cpu_time"],
+                    "gre": gre,
+                    "gre_next": gre_next,
+                }
+            )
+            gre = gre_next
+    return pd.DataFrame(decisions, columns=["cpu_time", "gre", "gre_next"])
+
+
+def main():
+    # Setup logging
+    log.setLevel(logging.INFO)
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="stats parquet file to replay")
+    parser.add_argument(
+        "-c", type=str, default="throughput", help="load or throughput controller"
+    )
+    parser.add_argument(
+        "-g", type=int, nargs=3, default=[2, 15, 15], help="initial GRE"
+    )
+    args = parser.parse_args()
+
+    # Replay and print decisions
+    df = pd.read_parquet(args.path)
+    print(replay(df, new(args.c), tuple(args.g)).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
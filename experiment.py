@@ -4,11 +4,16 @@ import argparse
 import logging
 import os
 import re
+import shutil
 import time
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 import fluffi
+import metrics
+import replay
 
 # Configuration
 FUZZBENCH_DIR = os.path.expanduser("~/fuzzbench_out/")
@@ -25,10 +30,14 @@ BENCHMARKS = [
     "njs_njs_process_script_fuzzer",
 ]
 NUM_TRIALS = 20
-CHECK_CPU_TIME_INTERVAL = 10.0  # 10 seconds in real time
+CHECK_CPU_TIME_INTERVAL = 10.0  # 10 seconds in real time, until the rate is known
+POLL_MIN = 1.0  # 1 second in real time
+POLL_MAX = 60.0  # 1 minute in real time
+RATE_SMOOTHING = 0.5
 GET_STATS_INTERVAL = 10 * 60  # 10 minutes in CPU time
 TRIAL_TIME = 30 * 60 * 60  # 30 hours in CPU time
 SEED_NUM_LIMIT = 4000
+CAPTURE = False  # stream new coverage and crashes from the DB at each stats sample
 
 # Constants
 N_MIN = 5
@@ -37,6 +46,30 @@ EXP_BASE_DIR = os.path.expanduser("~/fluffi-tools/experiments/")
 FUZZBENCH_DIR_REMOTE = "fuzzbench/"
 DUMP_FMT = "{}.sql.gz"
 DATA_FMT = "{}.parquet"
+STATS_FMT = "{}.arrow"
+CAPTURE_FMT = "{}.capture"
+CAPTURE_SCHEMAS = {
+    "covered_blocks": pa.schema(
+        [
+            ("id", pa.int64()),
+            ("offset", pa.int64()),
+            ("time", pa.timestamp("s")),
+            ("cpu_time", pa.float64()),
+        ]
+    ),
+    "paths": pa.schema(
+        [("hash", pa.string()), ("counter", pa.int64()), ("cpu_time", pa.float64())]
+    ),
+    "crashes": pa.schema(
+        [
+            ("id", pa.int64()),
+            ("testcase", pa.int64()),
+            ("description", pa.string()),
+            ("time", pa.timestamp("s")),
+            ("cpu_time", pa.float64()),
+        ]
+    ),
+}
 PROGRESS_INTERVAL = 0.2
 
 # Get logger
@@ -51,7 +84,16 @@ def main():
     parser.add_argument(
         "-d", action="store_true", help="debug mode (more logs to stdout)"
     )
+    parser.add_argument("-r", action="store_true", help="reattach to a running fuzzjob")
+    parser.add_argument("-t", type=str, help="record client calls to a trace file")
+    parser.add_argument("-p", type=str, help="replay client calls from a trace file")
+    parser.add_argument("-s", type=str, help="scratch directory for replayed output")
+    parser.add_argument(
+        "-x", type=float, default=0, help="real seconds per replayed second (0)"
+    )
     args = parser.parse_args()
+    if args.p is not None and args.s is None:
+        parser.error("replaying requires a scratch directory (-s)")
 
     # Check host
     if args.n < N_MIN or args.n > N_MAX:
@@ -59,8 +101,9 @@ def main():
         exit(1)
     location = fluffi.LOCATION_FMT.format(args.n)
 
-    # Create experiment directory
-    exp_dir = os.path.join(EXP_BASE_DIR, args.name, location)
+    # Create experiment directory, replays write to the scratch directory
+    base_dir = EXP_BASE_DIR if args.p is None else args.s
+    exp_dir = os.path.join(base_dir, args.name, location)
     os.makedirs(exp_dir, exist_ok=True)
 
     # Setup logging
@@ -71,9 +114,22 @@ def main():
         datefmt="%m/%d/%Y %H:%M:%S",
     )
 
-    # Connect to instance and ensure nothing is running
+    # Record or replay client calls
+    if args.t is not None:
+        replay.record(args.t)
+    elif args.p is not None:
+        replay.replay(args.p, args.s, args.x)
+
+    # Serve live metrics
+    exporter = metrics.Exporter(location, metrics.METRICS_PORT + args.n, TRIAL_TIME)
+
+    # Connect to instance and ensure nothing is running, unless reattaching
     inst = fluffi.Instance(args.n)
-    inst.down()
+    if args.r:
+        fuzzjobs = inst.get_fuzzjobs()
+    else:
+        inst.down()
+        fuzzjobs = []
 
     # Iterate over number of trials
     for i in range(1, NUM_TRIALS + 1):
@@ -123,53 +179,92 @@ def main():
             # Check if trial already complete
             data_path = os.path.join(exp_benchmark_dir, DATA_FMT.format(trial))
             dump_path = os.path.join(exp_benchmark_dir, DUMP_FMT.format(trial))
+            stats_path = os.path.join(exp_benchmark_dir, STATS_FMT.format(trial))
+            capture_dir = os.path.join(exp_benchmark_dir, CAPTURE_FMT.format(trial))
             if os.path.isfile(data_path) and os.path.isfile(dump_path):
                 log.debug(f"Trial {trial_name} already complete, skipping")
                 continue
-            try:
-                os.remove(data_path)
-            except OSError:
-                pass
-            try:
-                os.remove(dump_path)
-            except OSError:
-                pass
-
-            # Start the experiment
-            log.info(f"Starting {trial_name}...")
+
+            # Find a running fuzzjob for this trial to reattach to, the one its
+            # stats were sampled from
             run_name = re.sub("[^0-9a-zA-Z]+", "", trial_name)
-            fuzzjob = inst.up(
-                run_name,
-                target_path_remote,
-                module,
-                seeds[:SEED_NUM_LIMIT],
-                library_path_remote,
-                linker_path_remote,
-            )
+            name = read_metadata(
+                data_path if os.path.isfile(data_path) else stats_path
+            ).get("fuzzjob")
+            fuzzjob = find_fuzzjob(fuzzjobs, run_name, name)
+
+            # Stats are compacted as soon as sampling ends, so a trial with them is
+            # only missing its dump, from a running or already archived fuzzjob.
+            # Archived dumps of aborted attempts of the trial are removed.
+            if os.path.isfile(data_path):
+                if fuzzjob is None:
+                    archived = [
+                        fuzzjob
+                        for fuzzjob in inst.get_archived_fuzzjobs()
+                        if re.fullmatch(rf"{run_name}\d+", fuzzjob.name)
+                    ]
+                    fuzzjob = find_fuzzjob(archived, run_name, name)
+                    for stale in archived:
+                        if stale is not fuzzjob:
+                            log.info(f"Removing stale dump of {stale.name}")
+                            stale.remove_dump()
+                else:
+                    inst.down()
+                    fuzzjobs = []
+                if fuzzjob is not None:
+                    log.info(f"Retrieving the dump of sampled trial {trial_name}...")
+                    fuzzjob.get_dump(dump_path)
+                    continue
+                log.error(f"Dump of sampled trial {trial_name} is lost, rerunning it")
+
+            for path in [data_path, dump_path] + ([] if fuzzjob else [stats_path]):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if fuzzjob is None:
+                shutil.rmtree(capture_dir, ignore_errors=True)
+
+            # Start the experiment or continue the running one
+            if fuzzjob is not None:
+                log.info(f"Reattaching to {trial_name}...")
+                stats = StatsWriter(stats_path, resume=True)
+                start_time = stats.metadata.get("start_time")
+                fuzzjob.reattach(
+                    stats.last, float(start_time) if start_time is not None else None
+                )
+                capture = (
+                    Capture(fuzzjob, capture_dir, resume=True) if CAPTURE else None
+                )
+            else:
+                if len(fuzzjobs) > 0:
+                    inst.down()
+                log.info(f"Starting {trial_name}...")
+                fuzzjob = inst.up(
+                    run_name,
+                    target_path_remote,
+                    module,
+                    seeds[:SEED_NUM_LIMIT],
+                    library_path_remote,
+                    linker_path_remote,
+                )
+                stats = StatsWriter(
+                    stats_path,
+                    metadata={
+                        "fuzzjob": fuzzjob.name,
+                        "start_time": str(fuzzjob.start_time),
+                    },
+                )
+                capture = Capture(fuzzjob, capture_dir) if CAPTURE else None
+            fuzzjobs = []
 
             # Collect stats
             log.info(f"Trial {trial_name} started")
-            stats = []
-            real_time_start = time.time()
-            cpu_time_prev = 0
-            progress_counter = PROGRESS_INTERVAL
-            while cpu_time_prev < TRIAL_TIME:
-                time.sleep(
-                    CHECK_CPU_TIME_INTERVAL
-                    - (time.time() - real_time_start) % CHECK_CPU_TIME_INTERVAL
-                )
-                cpu_time = fuzzjob.get_cpu_time()
-                if (cpu_time - cpu_time_prev) >= GET_STATS_INTERVAL:
-                    row = fuzzjob.get_stats()
-                    row["cpu_time"] = cpu_time
-                    row["real_time"] = time.time() - real_time_start
-                    stats.append(row)
-                    cpu_time_prev = cpu_time
-                    if cpu_time > (progress_counter * TRIAL_TIME):
-                        log.info(
-                            f"Trial {trial_name} is {int(progress_counter * 100)}% done"
-                        )
-                        progress_counter += PROGRESS_INTERVAL
+            exporter.set_trial(benchmark, trial)
+            row = collect_stats(fuzzjob, stats, trial_name, exporter, capture)
+            stats.close(data_path)
+            if capture is not None:
+                capture.close()
 
             # Bring down and dump data
             log.info(
@@ -179,10 +274,311 @@ def main():
             log.info(f"Trial {trial_name} complete, stopping...")
             inst.down()
             fuzzjob.get_dump(dump_path)
-            df = pd.DataFrame.from_records(stats)
-            df.to_parquet(data_path)
             log.info(f"Trial {trial_name} stopped and data collected")
 
 
+# The trial's fuzzjob is the one named in its stats. Stats written before names
+# were stored take the newest fuzzjob of the trial.
+def find_fuzzjob(fuzzjobs, run_name, name=None):
+    if name is not None:
+        return next((fuzzjob for fuzzjob in fuzzjobs if fuzzjob.name == name), None)
+    return max(
+        (
+            fuzzjob
+            for fuzzjob in fuzzjobs
+            if re.fullmatch(rf"{run_name}\d+", fuzzjob.name)
+        ),
+        key=lambda fuzzjob: int(fuzzjob.name[len(run_name) :]),
+        default=None,
+    )
+
+
+# Samples stats until the trial's CPU time runs out, returning the last sample,
+# with real time as wall time since the fuzzjob was started so it keeps running
+# while detached, and the rate taken from the CPU time found when reattaching
+def collect_stats(fuzzjob, stats, trial_name, exporter=None, capture=None):
+    cpu_time_prev = 0
+    progress_counter = PROGRESS_INTERVAL
+    row = stats.last
+    if row is not None:
+        cpu_time_prev = row["cpu_time"]
+        while cpu_time_prev > (progress_counter * TRIAL_TIME):
+            progress_counter += PROGRESS_INTERVAL
+    scheduler = Scheduler(fuzzjob.cpu_time)
+    if exporter is not None and row is not None:
+        exporter.observe_stats(row)
+    while cpu_time_prev < TRIAL_TIME:
+        time.sleep(scheduler.get_sleep_time())
+        cpu_time = fuzzjob.get_cpu_time()
+        scheduler.update(cpu_time)
+        if exporter is not None:
+            exporter.observe_cpu_time(cpu_time, scheduler.rate)
+        if cpu_time >= scheduler.checkpoint:
+            row = fuzzjob.get_stats()
+            row["cpu_time"] = cpu_time
+            # The grid point actually reached, polls that overshoot skip the
+            # points in between rather than relabel them
+            row["checkpoint"] = min(
+                cpu_time // GET_STATS_INTERVAL * GET_STATS_INTERVAL, TRIAL_TIME
+            )
+            row["real_time"] = time.time() - fuzzjob.start_time
+            stats.write(row)
+            if exporter is not None:
+                exporter.observe_stats(row)
+            if capture is not None:
+                capture.poll(cpu_time)
+            cpu_time_prev = cpu_time
+            scheduler.advance()
+            if cpu_time > (progress_counter * TRIAL_TIME):
+                log.info(f"Trial {trial_name} is {int(progress_counter * 100)}% done")
+                progress_counter += PROGRESS_INTERVAL
+    return row
+
+
+# Plans CPU time polls so stats land on the GET_STATS_INTERVAL grid, using the
+# smoothed rate at which the fuzzjob accrues CPU time per real second
+class Scheduler:
+    def __init__(self, cpu_time=0):
+        self.cpu_time = cpu_time
+        self.real_time = time.time()
+        self.rate = None
+        self.advance()
+
+    def advance(self):
+        self.checkpoint = min(
+            (self.cpu_time // GET_STATS_INTERVAL + 1) * GET_STATS_INTERVAL, TRIAL_TIME
+        )
+
+    def update(self, cpu_time):
+        real_time = time.time()
+        if real_time > self.real_time and cpu_time >= self.cpu_time:
+            rate = (cpu_time - self.cpu_time) / (real_time - self.real_time)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self.cpu_time = cpu_time
+        self.real_time = real_time
+
+    # Sleep until the checkpoint is expected, polling at least every POLL_MAX
+    def get_sleep_time(self):
+        if not self.rate:
+            return CHECK_CPU_TIME_INTERVAL
+        remaining = (self.checkpoint - self.cpu_time) / self.rate
+        return min(max(remaining, POLL_MIN), POLL_MAX)
+
+
+# Append-only stats file, each sample is flushed to disk as an Arrow IPC record batch.
+# Metadata like the fuzzjob's name is kept in the schema, through to the Parquet file.
+class StatsWriter:
+    def __init__(self, path, resume=False, schema=None, metadata=None):
+        self.path = path
+        self.schema = schema
+        self.metadata = dict(metadata or {})
+        self.writer = None
+        self.f = None
+        self.last = None
+
+        # Previously recorded samples are rewritten into a fresh stream
+        table = None
+        if resume and os.path.isfile(self.path):
+            table = read_stream(self.path)
+        if table is not None:
+            self.metadata.update(decode_metadata(table.schema.metadata))
+        if table is not None and table.num_rows > 0:
+            self.last = table.slice(table.num_rows - 1).to_pylist()[0]
+        self.rewrite(table)
+
+    # Starts a fresh stream holding the given samples, a fixed schema is written
+    # up front so the stream has columns even when empty
+    def rewrite(self, table):
+        if self.writer is not None:
+            self.writer.close()
+        if self.f is not None:
+            self.f.close()
+        self.writer = None
+        self.f = open(f"{self.path}.tmp", "wb")
+        if table is not None:
+            self.schema = self.schema or table.schema
+            for batch in table.cast(self.schema, safe=True).to_batches():
+                self.write_batch(batch)
+        if self.writer is None and self.schema is not None:
+            self.write_batch(pa.RecordBatch.from_pylist([], schema=self.schema))
+        os.replace(f"{self.path}.tmp", self.path)
+
+    # Rows are checked against the stream's schema, new columns are added to the
+    # earlier samples as nulls and values that don't fit their column raise
+    def write(self, row):
+        table = pa.Table.from_pylist([row])
+        if self.schema is not None:
+            missing = [name for name in self.schema.names if name not in row]
+            if len(missing) > 0:
+                raise ValueError(f"Stats row is missing columns {missing}")
+            new = [
+                field for field in table.schema if field.name not in self.schema.names
+            ]
+            if len(new) > 0:
+                log.info(f"Adding columns {[field.name for field in new]} to stats")
+                self.widen(new)
+            table = table.select(self.schema.names).cast(self.schema, safe=True)
+        for batch in table.to_batches():
+            self.write_batch(batch)
+        self.last = row
+
+    def widen(self, fields):
+        self.writer.close()
+        self.f.close()
+        self.writer = None
+        self.f = None
+        table = read_stream(self.path)
+        for field in fields:
+            table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+        self.schema = table.schema
+        self.rewrite(table)
+
+    def write_batch(self, batch):
+        if self.writer is None:
+            self.schema = self.schema or batch.schema
+            self.writer = pa.ipc.new_stream(
+                self.f, self.schema.with_metadata(self.metadata)
+            )
+        self.writer.write_batch(batch)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    # Compact into a single Parquet file and remove the stream
+    def close(self, data_path):
+        if self.writer is not None:
+            self.writer.close()
+        self.f.close()
+        table = pa.Table.from_pandas(read_stats(self.path), preserve_index=False)
+        metadata = {**(table.schema.metadata or {}), **self.metadata}
+        pq.write_table(table.replace_schema_metadata(metadata), data_path)
+        os.remove(self.path)
+
+
+# Streams the coverage and crashes of a running fuzzjob to a directory, fetching
+# only rows past the last captured ID so each poll stays small
+class Capture:
+    def __init__(self, fuzzjob, path, resume=False):
+        self.fuzzjob = fuzzjob
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        # Hashes already captured, with their counters from the last poll
+        self.counters = {}
+        paths_path = os.path.join(self.path, STATS_FMT.format("paths"))
+        if resume and os.path.isfile(paths_path):
+            df = read_stats(paths_path)
+            if len(df) > 0:
+                self.counters = dict(zip(df["hash"], df["counter"]))
+        self.writers = {
+            table: StatsWriter(
+                os.path.join(self.path, STATS_FMT.format(table)), resume, schema
+            )
+            for table, schema in CAPTURE_SCHEMAS.items()
+        }
+
+    def last_id(self, table):
+        last = self.writers[table].last
+        return 0 if last is None else int(last["id"])
+
+    def write(self, table, rows, cpu_time):
+        if len(rows) == 0:
+            return
+        schema = CAPTURE_SCHEMAS[table]
+        df = pd.DataFrame(rows, columns=schema.names[:-1])
+        if "time" in df.columns:
+            df["time"] = pd.to_datetime(df["time"])
+        df["cpu_time"] = float(cpu_time)
+        batch = pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False)
+        self.writers[table].write_batch(batch)
+        self.writers[table].last = df.iloc[-1].to_dict()
+
+    def poll(self, cpu_time):
+        log.debug(f"Capturing data for {self.fuzzjob.name}...")
+        blocks = self.fuzzjob.get_new_covered_blocks(self.last_id("covered_blocks"))
+        self.write("covered_blocks", blocks, cpu_time)
+        crashes = self.fuzzjob.get_new_crashes(self.last_id("crashes"))
+        self.write("crashes", crashes, cpu_time)
+
+        # Only newly found paths are written, counters are kept up to date here
+        paths = self.fuzzjob.get_paths()
+        new_paths = [row for row in paths if row[0] not in self.counters]
+        self.counters.update(paths)
+        self.write("paths", new_paths, cpu_time)
+        log.debug(
+            f"Captured {len(blocks)} blocks, {len(new_paths)} paths, and "
+            f"{len(crashes)} crashes for {self.fuzzjob.name}"
+        )
+
+    # Compacts each stream into a Parquet file, paths with their final counters
+    def close(self):
+        for table, writer in self.writers.items():
+            data_path = os.path.join(self.path, DATA_FMT.format(table))
+            writer.close(data_path)
+            if table == "paths" and len(self.counters) > 0:
+                df = pd.read_parquet(data_path)
+                df["counter"] = df["hash"].map(self.counters)
+                df.to_parquet(data_path)
+
+
+# Checks that a trial's capture was closed, so it holds all of the trial's data
+def is_captured(path):
+    return all(
+        os.path.isfile(os.path.join(path, DATA_FMT.format(table)))
+        for table in CAPTURE_SCHEMAS
+    )
+
+
+# Reads a stats stream as an Arrow table, ignoring a partially written last
+# sample, or None if not even the schema was written
+def read_stream(path):
+    schema = None
+    batches = []
+    try:
+        with pa.ipc.open_stream(path) as reader:
+            schema = reader.schema
+            for batch in reader:
+                batches.append(batch)
+    except (pa.ArrowInvalid, OSError) as e:
+        log.warn(f"Stats file {path} is truncated after {len(batches)} samples: {e}")
+    if schema is None:
+        return None
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+def read_stats(path):
+    table = read_stream(path)
+    if table is None:
+        return pd.DataFrame()
+    return table.to_pandas()
+
+
+# Metadata stored with a trial's stats, in its stream or its Parquet file
+def read_metadata(path):
+    try:
+        if path.endswith(".parquet"):
+            metadata = pq.read_schema(path).metadata
+        else:
+            with pa.ipc.open_stream(path) as reader:
+                metadata = reader.schema.metadata
+    except (pa.ArrowInvalid, OSError):
+        return {}
+    return decode_metadata(metadata)
+
+
+def decode_metadata(metadata):
+    return {
+        key.decode(): value.decode()
+        for key, value in (metadata or {}).items()
+        if key != b"pandas"
+    }
+
+
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except replay.TraceEnd as e:
+        log.info(f"Replay ended: {e}")
+    replay.log_summary()
@@ -1,14 +1,33 @@
+import functools
 import gzip
+import operator
 import os
-import re
 
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 
 import experiment
 import fluffi
+import sqldump
 
 # Constants
 PROCESS_SQL = False
+ROW_GROUP_SIZE = 100000
+TABLES = {
+    "measurements": "measurements.parquet",
+    "covered_blocks": "covered_blocks.parquet",
+    "coverage_curves": "coverage_curves.parquet",
+    "coverage_offsets": "coverage_offsets.parquet",
+    "coverage_bitsets": "coverage_bitsets.parquet",
+    "paths": "paths.parquet",
+    "path_hashes": "path_hashes.parquet",
+    "crashes": "crashes.parquet",
+    "crash_buckets": "crash_buckets.parquet",
+    "crash_members": "crash_members.parquet",
+}
+COVERAGE_RESOLUTION = 60  # 1 minute in CPU time
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 LOCATIONS = [
     fluffi.LOCATION_FMT.format(n) for n in range(experiment.N_MIN, experiment.N_MAX + 1)
 ]
@@ -72,22 +91,80 @@ def main():
             )
 
     # Export measurements
-    df = pd.concat(measurements, ignore_index=True)
-    df = df.loc[df["cpu_time"] <= experiment.TRIAL_TIME]
-    df.to_parquet("measurements.parquet")
+    # The last sample overshoots the trial time, so samples taken on the
+    # checkpoint grid are kept by their checkpoint rather than their CPU time
+    df_measurements = pd.concat(measurements, ignore_index=True)
+    sample_time = df_measurements["cpu_time"]
+    if "checkpoint" in df_measurements:
+        sample_time = df_measurements["checkpoint"].fillna(sample_time)
+    df_measurements = df_measurements.loc[sample_time <= experiment.TRIAL_TIME]
+    export(df_measurements, "measurements")
 
     if PROCESS_SQL:
-        # Export covered blocks
-        df = pd.concat(covered_blocks, ignore_index=True)
-        df.to_parquet("covered_blocks.parquet")
+        # Export covered blocks timed in CPU time, their coverage curves, and their
+        # per-trial bitsets
+        df_covered_blocks = pd.concat(covered_blocks, ignore_index=True)
+        df_covered_blocks["cpu_time"] = block_cpu_times(
+            df_covered_blocks, df_measurements
+        )
+        export(df_covered_blocks, "covered_blocks")
+        export(coverage_curves(df_covered_blocks), "coverage_curves")
+        df_offsets, df_bitsets = coverage_bitsets(df_covered_blocks)
+        export(df_offsets, "coverage_offsets")
+        export(df_bitsets, "coverage_bitsets")
 
-        # Export paths
+        # Export paths encoded against a dictionary of hashes per benchmark
         df = pd.concat(paths, ignore_index=True)
-        df.to_parquet("paths.parquet")
+        df_paths, df_path_hashes = encode_paths(df)
+        export(df_paths, "paths")
+        export(df_path_hashes, "path_hashes")
 
-        # Export crashes
+        # Export crashes timed in CPU time, like the covered blocks, and the
+        # cross-trial crash index
         df = pd.concat(crashes, ignore_index=True)
-        df.to_parquet("crashes.parquet")
+        df["cpu_time"] = db_cpu_times(df, df_covered_blocks, df_measurements)
+        export(df, "crashes")
+        df_buckets, df_members = crash_index(df)
+        export(df_buckets, "crash_buckets")
+        export(df_members, "crash_members")
+
+
+# Writes a table grouped by benchmark, experiment, and trial so that filters on
+# them in load() can skip whole row groups
+def export(df, table):
+    keys = [key for key in ["benchmark", "experiment", "trial"] if key in df.columns]
+    df = df.sort_values(keys, kind="stable") if len(keys) > 0 else df
+    df.to_parquet(TABLES[table], index=False, row_group_size=ROW_GROUP_SIZE)
+
+
+# Loads a consolidated table with the column selection and filters pushed down to
+# the Parquet scan, returning an iterator of DataFrames if batch_size is given
+def load(
+    table,
+    experiments=None,
+    benchmarks=None,
+    trials=None,
+    columns=None,
+    cpu_time_max=None,
+    batch_size=None,
+):
+    filters = []
+    if experiments is not None:
+        filters.append(ds.field("experiment").isin(experiments))
+    if benchmarks is not None:
+        filters.append(ds.field("benchmark").isin(benchmarks))
+    if trials is not None:
+        filters.append(ds.field("trial").isin(trials))
+    if cpu_time_max is not None:
+        filters.append(ds.field("cpu_time") <= cpu_time_max)
+    scanner = ds.dataset(TABLES[table], format="parquet").scanner(
+        columns=columns,
+        filter=functools.reduce(operator.and_, filters) if len(filters) > 0 else None,
+        **({} if batch_size is None else {"batch_size": batch_size}),
+    )
+    if batch_size is None:
+        return scanner.to_table().to_pandas()
+    return (batch.to_pandas() for batch in scanner.to_batches() if batch.num_rows > 0)
 
 
 # Processes each benchmark
@@ -108,66 +185,392 @@ def process(
         if name_mapping == RUN2_NAMES and location in ["1021-7", "1021-8"]:
             trial += 10
 
-        # Read from SQL
-        if filename.endswith(".sql.gz") and PROCESS_SQL:
-
-            # Decompress the file
-            with gzip.open(file_path, "rb") as f:
-                dump = f.read()
-
-            # Create lists
-            covered_blocks_trial = []
-            crashes_trial = []
-
-            # Iterate over the lines
-            for line in dump.split(b"\n"):
-                if line.startswith(b"INSERT INTO `covered_blocks` VALUES"):
-                    matches = re.findall(rb"\(\d+,\d+,\d+,(\d+),'(.+?)'\)", line)
-                    df = pd.DataFrame(matches, columns=["offset", "time"])
-                    df["offset"] = df["offset"].astype(int)
-                    df["time"] = pd.to_datetime(df["time"].str.decode("utf-8"))
-                    covered_blocks_trial.append(df)
-                elif line.startswith(b"INSERT INTO `edge_coverage` VALUES"):
-                    matches = re.findall(rb"\('(.+?)',(\d+)\)", line)
-                    df = pd.DataFrame(matches, columns=["hash", "counter"])
-                    df["hash"] = df["hash"].str.decode("utf-8")
-                    df["counter"] = df["counter"].astype(int)
-                    df["experiment"] = name_mapping[location]
-                    df["benchmark"] = benchmark
-                    df["trial"] = trial
-                    paths.append(df)
-                elif line.startswith(b"INSERT INTO `crash_descriptions` VALUES"):
-                    matches = re.findall(rb"\(\d+,\d+,'(.+?)'\)", line)
-                    if len(matches) > 0:
-                        df = pd.DataFrame(matches, columns=["description"])
-                        df["description"] = df["description"].str.decode("utf-8")
-                        crashes_trial.append(df)
+        # Read from SQL, preferring the data captured during the trial to the dump
+        capture_path = os.path.join(
+            benchmark_dir, experiment.CAPTURE_FMT.format(filename.split(".")[0])
+        )
+        if PROCESS_SQL and (
+            (filename.endswith(".sql.gz") and not experiment.is_captured(capture_path))
+            or (filename.endswith(".capture") and experiment.is_captured(file_path))
+        ):
+            if filename.endswith(".capture"):
+                df_covered_blocks, df_paths, df_crashes = read_capture(file_path)
+            else:
+                df_covered_blocks, df_paths, df_crashes = parse_dump(
+                    read_dump(file_path)
+                )
 
             # Dedup covered blocks
-            df = pd.concat(covered_blocks_trial, ignore_index=True)
-            df = df.sort_values("time").drop_duplicates("offset", keep="first")
+            df = dedup_covered_blocks(df_covered_blocks)
             df["experiment"] = name_mapping[location]
             df["benchmark"] = benchmark
             df["trial"] = trial
             covered_blocks.append(df)
 
+            # Label paths
+            df = df_paths
+            df["experiment"] = name_mapping[location]
+            df["benchmark"] = benchmark
+            df["trial"] = trial
+            paths.append(df)
+
             # Dedup crashes
-            if len(crashes_trial) > 0:
-                df = pd.concat(crashes_trial, ignore_index=True)
-                df = df.drop_duplicates("description")
+            if len(df_crashes) > 0:
+                df = dedup_crashes(df_crashes)
                 df["experiment"] = name_mapping[location]
                 df["benchmark"] = benchmark
                 df["trial"] = trial
                 crashes.append(df)
 
-        # Read from parquet
-        if filename.endswith(".parquet"):
-            df = pd.read_parquet(file_path)
+        # Read from parquet, or from the stats stream of an unfinished trial
+        if filename.endswith(".parquet") or (
+            filename.endswith(".arrow")
+            and not os.path.isfile(
+                os.path.join(
+                    benchmark_dir, experiment.DATA_FMT.format(filename.split(".")[0])
+                )
+            )
+        ):
+            if filename.endswith(".parquet"):
+                df = pd.read_parquet(file_path)
+            else:
+                df = experiment.read_stats(file_path)
             df["experiment"] = name_mapping[location]
             df["benchmark"] = benchmark
             df["trial"] = trial
             measurements.append(df)
 
 
+def read_dump(file_path):
+    with gzip.open(file_path, "rb") as f:
+        return f.read()
+
+
+# Reads the covered blocks, paths, and crashes of a closed capture, in the same
+# form as parse_dump
+def read_capture(path):
+    return (
+        pd.read_parquet(
+            os.path.join(path, "covered_blocks.parquet"), columns=["offset", "time"]
+        ),
+        pd.read_parquet(
+            os.path.join(path, "paths.parquet"), columns=["hash", "counter"]
+        ),
+        pd.read_parquet(
+            os.path.join(path, "crashes.parquet"),
+            columns=["testcase", "description", "time"],
+        ),
+    )
+
+
+# Parses the covered blocks, paths, and crashes out of a decompressed dump
+def parse_dump(dump):
+    lines = dump.split(b"\n")
+    tables = sqldump.read_tables(
+        lines,
+        {
+            "covered_blocks": ["Offset", "TimeOfInsertion"],
+            "edge_coverage": ["hash", "counter"],
+            "crash_descriptions": ["CreatorTestcaseID", "CrashFootprint"],
+        },
+    )
+    df_covered_blocks = to_pandas(
+        tables.get("covered_blocks"),
+        {"Offset": "offset", "TimeOfInsertion": "time"},
+    )
+    df_paths = to_pandas(
+        tables.get("edge_coverage"), {"hash": "hash", "counter": "counter"}
+    )
+    df_crashes = to_pandas(
+        tables.get("crash_descriptions"),
+        {"CreatorTestcaseID": "testcase", "CrashFootprint": "description"},
+    )
+
+    # Crashes are timed by the testcase that caused them, only read if there are
+    # any since the testcases are the bulk of the dump
+    if len(df_crashes) > 0:
+        tables = sqldump.read_tables(
+            lines, {"interesting_testcases": ["ID", "TimeOfInsertion"]}
+        )
+        df_testcases = to_pandas(
+            tables.get("interesting_testcases"),
+            {"ID": "testcase", "TimeOfInsertion": "time"},
+        )
+    else:
+        df_testcases = pd.DataFrame(columns=["testcase", "time"])
+    df_crashes = df_crashes.merge(df_testcases, on="testcase", how="left")
+
+    return df_covered_blocks, df_paths, df_crashes
+
+
+def to_pandas(table, columns):
+    if table is None:
+        return pd.DataFrame(columns=list(columns.values()))
+    return table.to_pandas().rename(columns=columns)
+
+
+def concat(dfs, columns):
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def dedup_covered_blocks(df):
+    return df.sort_values("time").drop_duplicates("offset", keep="first")
+
+
+def dedup_crashes(df):
+    return df.sort_values("time").drop_duplicates("description", keep="first")
+
+
+# Converts each block's discovery time to CPU time by interpolating its trial's
+# (real_time, cpu_time) samples, with the trial's first block as real time zero
+# since the DB clock and timezone differ from the orchestrator's
+def block_cpu_times(df_covered_blocks, df_measurements):
+    return db_cpu_times(df_covered_blocks, df_covered_blocks, df_measurements)
+
+
+# Converts DB times of a trial's rows to CPU time like block_cpu_times, so crashes
+# are timed from the same first block as the coverage
+def db_cpu_times(df, df_covered_blocks, df_measurements):
+    keys = ["experiment", "benchmark", "trial"]
+    cpu_times = np.full(len(df), np.nan)
+    samples = df_measurements.groupby(keys).indices
+    starts = df_covered_blocks.groupby(keys)["time"].min().to_dict()
+    times = df["time"].to_numpy(dtype="datetime64[ns]")
+    for key, rows in df.groupby(keys).indices.items():
+        if key not in samples or key not in starts:
+            continue
+        df_samples = df_measurements.iloc[samples[key]].sort_values("real_time")
+        start = starts[key].to_datetime64()
+        real_times = (times[rows] - start) / np.timedelta64(1, "s")
+        cpu_times[rows] = np.interp(
+            real_times,
+            np.concatenate([[0], df_samples["real_time"].to_numpy()]),
+            np.concatenate([[0], df_samples["cpu_time"].to_numpy()]),
+        )
+    return cpu_times
+
+
+# Number of covered blocks at every resolution seconds of CPU time for each trial
+def coverage_curves(df_covered_blocks, resolution=COVERAGE_RESOLUTION):
+    grid = np.arange(0, experiment.TRIAL_TIME + resolution, resolution)
+    cpu_times = df_covered_blocks["cpu_time"].to_numpy()
+    dfs = []
+    for (exp, benchmark, trial), rows in df_covered_blocks.groupby(
+        ["experiment", "benchmark", "trial"]
+    ).indices.items():
+        dfs.append(
+            pd.DataFrame(
+                {
+                    "experiment": exp,
+                    "benchmark": benchmark,
+                    "trial": trial,
+                    "cpu_time": grid,
+                    "covered_blocks": np.searchsorted(
+                        np.sort(cpu_times[rows]), grid, side="right"
+                    ),
+                }
+            )
+        )
+    return pd.concat(dfs, ignore_index=True)
+
+
+# Packs each trial's covered blocks into a bitset over the sorted offsets its
+# benchmark's trials covered, returning the offsets and the bitsets
+def coverage_bitsets(df):
+    dfs_offsets = []
+    rows = []
+    for benchmark, df_benchmark in df.groupby("benchmark", sort=True):
+        offsets = np.unique(df_benchmark["offset"].to_numpy())
+        dfs_offsets.append(pd.DataFrame({"benchmark": benchmark, "offset": offsets}))
+        index = np.searchsorted(offsets, df_benchmark["offset"].to_numpy())
+        for (exp, trial), rows_trial in df_benchmark.groupby(
+            ["experiment", "trial"], sort=True
+        ).indices.items():
+            bits = np.zeros(len(offsets), dtype=bool)
+            bits[index[rows_trial]] = True
+            rows.append(
+                {
+                    "experiment": exp,
+                    "benchmark": benchmark,
+                    "trial": trial,
+                    "bits": np.packbits(bits).tobytes(),
+                }
+            )
+    return pd.concat(dfs_offsets, ignore_index=True), pd.DataFrame(rows)
+
+
+# Set algebra over the coverage bitsets of any group of trials
+class Coverage:
+    def __init__(
+        self,
+        offsets_path="coverage_offsets.parquet",
+        bitsets_path="coverage_bitsets.parquet",
+    ):
+        df_offsets = pd.read_parquet(offsets_path)
+        self.offsets = {
+            benchmark: df["offset"].to_numpy()
+            for benchmark, df in df_offsets.groupby("benchmark")
+        }
+        self.df = pd.read_parquet(bitsets_path)
+        self.df["bits"] = [
+            np.frombuffer(bits, dtype=np.uint8) for bits in self.df["bits"]
+        ]
+
+    # Stacks the bitsets of a benchmark's trials, one row per trial
+    def select(self, benchmark, experiments=None, trials=None):
+        df = self.df.loc[self.df["benchmark"] == benchmark]
+        if experiments is not None:
+            df = df.loc[df["experiment"].isin(experiments)]
+        if trials is not None:
+            df = df.loc[df["trial"].isin(trials)]
+        if len(df) == 0:
+            return np.zeros((0, (len(self.offsets[benchmark]) + 7) // 8), np.uint8)
+        return np.stack(df["bits"].to_numpy())
+
+    def union(self, benchmark, experiments=None, trials=None):
+        return np.bitwise_or.reduce(self.select(benchmark, experiments, trials))
+
+    # An empty selection covers nothing, rather than the all ones identity
+    def intersection(self, benchmark, experiments=None, trials=None):
+        bits = self.select(benchmark, experiments, trials)
+        if len(bits) == 0:
+            return np.zeros(bits.shape[1], np.uint8)
+        return np.bitwise_and.reduce(bits)
+
+    @staticmethod
+    def difference(bits_a, bits_b):
+        return bits_a & ~bits_b
+
+    # Counts set bits, masking the padding of the last byte past the offsets
+    def cardinality(self, benchmark, bits):
+        n = len(self.offsets[benchmark])
+        if n % 8 != 0 and len(bits) > 0:
+            bits = bits.copy()
+            bits[-1] &= 0xFF << (8 - n % 8) & 0xFF
+        return int(POPCOUNT[bits].sum(dtype=np.int64))
+
+    def blocks(self, benchmark, bits):
+        offsets = self.offsets[benchmark]
+        return offsets[np.unpackbits(bits, count=len(offsets)).astype(bool)]
+
+
+# Replaces each edge hash with an int32 path ID that is unique within its benchmark,
+# returning the encoded paths and the dictionary of hashes as binary
+def encode_paths(df):
+    dfs_paths = []
+    dfs_hashes = []
+    for benchmark, df_benchmark in df.groupby("benchmark", sort=True):
+        codes, uniques = pd.factorize(df_benchmark["hash"])
+        dfs_paths.append(
+            pd.DataFrame(
+                {
+                    "experiment": df_benchmark["experiment"].to_numpy(),
+                    "benchmark": benchmark,
+                    "trial": df_benchmark["trial"].to_numpy(dtype=np.int8),
+                    "path": codes.astype(np.int32),
+                    "counter": df_benchmark["counter"].to_numpy(),
+                }
+            )
+        )
+        dfs_hashes.append(
+            pd.DataFrame(
+                {
+                    "benchmark": benchmark,
+                    "path": np.arange(len(uniques), dtype=np.int32),
+                    "hash": [encode_hash(h) for h in uniques],
+                }
+            )
+        )
+    df_paths = pd.concat(dfs_paths, ignore_index=True)
+    df_paths["experiment"] = df_paths["experiment"].astype(
+        pd.CategoricalDtype(EXPERIMENTS)
+    )
+    df_paths["benchmark"] = df_paths["benchmark"].astype(
+        pd.CategoricalDtype(experiment.BENCHMARKS)
+    )
+    return df_paths, pd.concat(dfs_hashes, ignore_index=True)
+
+
+def encode_hash(h):
+    try:
+        return bytes.fromhex(h)
+    except ValueError:
+        return h.encode("utf-8")
+
+
+# Number of distinct paths in each group of encoded paths
+def distinct_paths(df_paths, by=("benchmark", "experiment")):
+    by = list(by)
+    return df_paths.drop_duplicates(by + ["path"]).groupby(by, observed=True).size()
+
+
+# Paths found by the rows in the mask and by no other row, e.g. only FAST schedules
+def paths_only_in(df_paths, mask):
+    mask = np.asarray(mask)
+    keys = (
+        df_paths["benchmark"].cat.codes.to_numpy().astype(np.int64) << 32
+    ) | df_paths["path"].to_numpy()
+    keys = np.setdiff1d(
+        np.unique(keys[mask]), np.unique(keys[~mask]), assume_unique=True
+    )
+    return pd.DataFrame(
+        {
+            "benchmark": pd.Categorical.from_codes(
+                keys >> 32, df_paths["benchmark"].cat.categories
+            ),
+            "path": (keys & 0xFFFFFFFF).astype(np.int32),
+        }
+    )
+
+
+# Buckets crashes across all trials by the hash of their normalized description,
+# returning one row per bucket and one row per trial that found the bucket
+def crash_index(df):
+    normalized = df["description"].str.strip().str.replace(r"\s+", " ", regex=True)
+    df = df.assign(hash=pd.util.hash_array(normalized.to_numpy()))
+    df["bucket"] = df.groupby(["benchmark", "hash"], sort=False).ngroup()
+    df["bucket"] = df["bucket"].astype("int32")
+    df_buckets = df.groupby("bucket", sort=True).agg(
+        benchmark=("benchmark", "first"),
+        hash=("hash", "first"),
+        description=("description", "first"),
+        first_seen=("cpu_time", "min"),
+    )
+    df_members = df.groupby(
+        ["bucket", "experiment", "benchmark", "trial"],
+        sort=True,
+        as_index=False,
+        observed=True,
+    ).agg(first_seen=("cpu_time", "min"))
+    df_members["experiment"] = df_members["experiment"].astype("category")
+    df_members["benchmark"] = df_members["benchmark"].astype(
+        pd.CategoricalDtype(experiment.BENCHMARKS)
+    )
+    df_members["trial"] = df_members["trial"].astype("int8")
+    return df_buckets.reset_index(), df_members
+
+
+# Buckets found by only the given experiment
+def crashes_unique_to(df_members, exp):
+    experiments = df_members.groupby("bucket", observed=True)["experiment"]
+    df = experiments.agg(["nunique", "first"])
+    return df.index[(df["nunique"] == 1) & (df["first"] == exp)].to_numpy()
+
+
+# Buckets found by at least n trials of an experiment, with their trial counts
+def crashes_found_by(df_members, n, exp=None):
+    if exp is not None:
+        df_members = df_members.loc[df_members["experiment"] == exp]
+    df = (
+        df_members.groupby(["bucket", "experiment"], observed=True)["trial"]
+        .nunique()
+        .rename("trials")
+        .reset_index()
+    )
+    return df.loc[df["trials"] >= n]
+
+
 if __name__ == "__main__":
     main()
@@ -1,10 +1,13 @@
+import functools
 import logging
 import os
+import re
+import shlex
 import subprocess
 import time
 
 import util
-from fuzzjob import Fuzzjob
+from fuzzjob import DB_FUZZJOB_FMT, DUMP_PATH_FMT, Fuzzjob
 
 # Constants
 FLUFFI_PATH_FMT = os.path.expanduser("~/fluffi{}/")
@@ -12,7 +15,9 @@ LOCATION_FMT = "1021-{}"
 SSH_HOST_FMT = "host{}"
 SSH_MASTER_FMT = "master{}"
 SSH_WORKER_FMT = "worker{}"
-WORKER_NAME_FMT = "fluffi-1021-{}-Linux1"
+SSH_WORKER_EXTRA_FMT = "worker{}-{}"
+WORKER_NAME_FMT = "fluffi-1021-{}-Linux{}"
+WORKERS = 1  # per location, extra workers are worker{n}-{i} in the SSH config
 ARCH = "x64"
 DEPLOY_ZIP_NAME = "fluffi.zip"
 FLUFFI_DIR = "/home/fluffi_linux_user/fluffi/ramdisk/"
@@ -22,6 +27,34 @@ FLUFFI_URL = "http://web.fluffi:8880"
 PM_URL = "http://pole.fluffi:8888/api/v2"
 DB_NAME = "fluffi_gm"
 LM = 1
+PRUNE_TESTCASE_AGE = 30  # minutes since a testcase file was last modified
+PRUNE_LOG_SIZE = 100 * 1024  # KiB, larger agent logs are truncated in place
+PRUNE_POLICIES = [
+    (
+        "testcase",
+        f"find {os.path.join(FLUFFI_ARCH_DIR, 'testcaseFiles/')} -type f "
+        f"-mmin +{PRUNE_TESTCASE_AGE} -printf '%s\\n' -delete",
+    ),
+    (
+        "log",
+        f"find {os.path.join(FLUFFI_ARCH_DIR, 'logs/')} -type f "
+        f"-size +{PRUNE_LOG_SIZE}k -printf '%s\\n' -exec truncate -s 0 {{}} +",
+    ),
+    ("rotated log", "sudo find /var/log -name '*.gz' -printf '%s\\n' -delete"),
+]
+CGROUP = False  # place agents in cgroup v2 groups per role, unvalidated on workers
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_FMT = "fluffi-{}"
+CGROUP_CPUS = None  # cpuset of the agents like "2-15", or None for all CPUs
+CGROUP_QUOTA = None  # CPUs of quota for the agents like 13.5, or None for no limit
+CGROUP_PERIOD = 100000  # microseconds
+CGROUP_ROLES = {
+    "lm": "LocalManager",
+    "gen": "TestcaseGenerator",
+    "run": "TestcaseRunner",
+    "eva": "TestcaseEvaluator",
+}
+CLK_TCK = 100  # clock ticks per second in /proc/<pid>/stat
 
 # Get logger
 log = logging.getLogger("fluffi")
@@ -33,25 +66,40 @@ class Instance:
         self.n = n
         self.fluffi_path = FLUFFI_PATH_FMT.format(self.n)
         self.location = LOCATION_FMT.format(self.n)
-        self.worker_name = WORKER_NAME_FMT.format(self.n)
+        self.workers = [Worker(self.n, i) for i in range(1, WORKERS + 1)]
         self.master_addr = util.get_ssh_addr(SSH_MASTER_FMT.format(self.n))
+        self.agents_pending = False
+        self.cgroup = CGROUP
 
-        # Connect to SSH and DB
-        self.ssh_host = util.FaultTolerantSSHAndSFTPClient(SSH_HOST_FMT.format(self.n))
-        self.ssh_master = util.FaultTolerantSSHAndSFTPClient(
-            SSH_MASTER_FMT.format(self.n)
-        )
-        self.ssh_worker = util.FaultTolerantSSHAndSFTPClient(
-            SSH_WORKER_FMT.format(self.n)
-        )
-        self.db = util.FaultTolerantDBClient(
+        # Make sure the proxy is up if used, clients connect on first use
+        if util.HTTP_VIA == "socks":
+            self.check_proxy()
+
+    # --- Clients ---
+
+    @functools.cached_property
+    def ssh_host(self):
+        return util.FaultTolerantSSHAndSFTPClient(SSH_HOST_FMT.format(self.n))
+
+    @functools.cached_property
+    def ssh_master(self):
+        return util.FaultTolerantSSHAndSFTPClient(SSH_MASTER_FMT.format(self.n))
+
+    @functools.cached_property
+    def db(self):
+        return util.FaultTolerantDBClient(
             host=self.master_addr, user=DB_NAME, password=DB_NAME
         )
 
-        # Check the proxy and initialize the session
-        self.check_proxy()
-        self.s = util.FaultTolerantSession(self)
-        self.s.get(FLUFFI_URL)
+    @functools.cached_property
+    def s(self):
+        return self.new_session()
+
+    @functools.cached_property
+    def pm(self):
+        s = self.new_session()
+        s.auth = ("admin", "admin")
+        return s
 
     # --- High Level Functionality ---
 
@@ -96,13 +144,12 @@ class Instance:
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
         )
-        self.ssh_worker.put(
-            os.path.join(self.fluffi_path, "core/x86-64/bin/", DEPLOY_ZIP_NAME),
-            os.path.join(FLUFFI_ARCH_DIR, DEPLOY_ZIP_NAME),
-        )
-        self.ssh_worker.exec_command(
-            f"cd {FLUFFI_ARCH_DIR} && unzip -o {DEPLOY_ZIP_NAME}", check=True
-        )
+        for worker in self.workers:
+            worker.ssh.put(
+                os.path.join(self.fluffi_path, "core/x86-64/bin/", DEPLOY_ZIP_NAME),
+                os.path.join(FLUFFI_ARCH_DIR, DEPLOY_ZIP_NAME),
+            )
+        self.exec_workers(f"cd {FLUFFI_ARCH_DIR} && unzip -o {DEPLOY_ZIP_NAME}")
         log.debug("New build transferred")
 
         log.debug("Deployed")
@@ -118,11 +165,13 @@ class Instance:
     ):
         log.debug(f"Starting fuzzjob with prefix {name_prefix}...")
         self.set_kernel_vals()
+        self.set_cgroups()
         fuzzjob = self.new_fuzzjob(
             name_prefix, target_path, module, seeds, library_path, linker_path
         )
-        self.set_lm(LM)
+        self.set_lm(LM, flush=False)
         fuzzjob.set_gre()
+        fuzzjob.start_time = time.time()
         log.debug(f"Started fuzzjob named {fuzzjob.name}")
         return fuzzjob
 
@@ -130,7 +179,7 @@ class Instance:
         log.debug("Stopping...")
         fuzzjobs = self.get_fuzzjobs()
         for fuzzjob in fuzzjobs:
-            fuzzjob.set_gre(True)
+            fuzzjob.set_gre(True, flush=False)
         self.set_lm(0)
         self.kill_leftover_agents()
         for fuzzjob in fuzzjobs:
@@ -146,6 +195,11 @@ class Instance:
     # --- SSH ---
 
     def check_proxy(self):
+        # Reuse the proxy if it's healthy
+        if util.check_socks_proxy(self.master_addr):
+            log.debug("Proxy is healthy")
+            return
+
         # Kill proxy if it's already there
         log.debug("Killing proxy...")
         self.ssh_master.exec_command(f"sudo fuser -k {util.PROXY_PORT}/tcp")
@@ -161,30 +215,125 @@ class Instance:
 
     def kill_leftover_agents(self):
         log.debug("Killing leftover agents...")
-        self.ssh_worker.exec_command(f"pkill -f '{FLUFFI_ARCH_DIR}'")
+        self.exec_workers(f"pkill -f '{FLUFFI_ARCH_DIR}'", check=False)
         log.debug("Killed leftover agents")
 
     def clear_dirs(self):
         log.debug("Deleting log/testcase directories...")
-        self.ssh_worker.exec_command(
+        self.exec_workers(
             f"sudo rm -rf /var/log/*.gz {os.path.join(FLUFFI_ARCH_DIR, 'logs/')} "
-            f"{os.path.join(FLUFFI_ARCH_DIR, 'testcaseFiles/')}"
+            f"{os.path.join(FLUFFI_ARCH_DIR, 'testcaseFiles/')}",
+            check=False,
         )
         log.debug("Log/testcase directories deleted")
 
+    # Frees space on the workers without touching files the agents still use:
+    # testcases are deleted only once stale, logs are truncated since the agents
+    # keep them open, returning the number of files and bytes pruned
+    def prune(self):
+        log.debug("Pruning workers...")
+        files_total = 0
+        size_total = 0
+        for kind, command in PRUNE_POLICIES:
+            for worker, output in zip(
+                self.workers, self.exec_workers(command, check=False)
+            ):
+                sizes = [int(size) for size in output.split()]
+                if len(sizes) == 0:
+                    continue
+                log.info(
+                    f"Pruned {len(sizes)} {kind} files of {sum(sizes)} bytes "
+                    f"on {worker.name}"
+                )
+                files_total += len(sizes)
+                size_total += sum(sizes)
+        log.debug("Workers pruned")
+        return files_total, size_total
+
     def set_kernel_vals(self):
         log.debug("Setting kernel values...")
         self.ssh_host.exec_command("sudo /home/maverick/bin/afl-setup.sh", check=True)
         log.debug("Kernel values set")
 
+    # Recreates the location's cgroup with the cpuset and quota and an empty group
+    # per role, groups of the last fuzzjob are only removed once its agents are gone.
+    # If any worker fails, CPU time is summed from ps instead for the fuzzjob.
+    def set_cgroups(self):
+        self.cgroup = CGROUP
+        if not CGROUP:
+            return
+        log.debug("Setting cgroups...")
+        cgroup_dir = os.path.join(CGROUP_ROOT, CGROUP_FMT.format(self.location))
+        roles = " ".join(CGROUP_ROLES)
+        quota = "max" if CGROUP_QUOTA is None else int(CGROUP_QUOTA * CGROUP_PERIOD)
+        cleanup = [
+            f"for role in {roles}; do rmdir {cgroup_dir}/$role; done 2>/dev/null",
+            f"rmdir {cgroup_dir} 2>/dev/null",
+        ]
+        setup = [
+            f"echo '+cpu +cpuset' > {CGROUP_ROOT}/cgroup.subtree_control",
+            f"mkdir -p {cgroup_dir}",
+            f"echo '{quota} {CGROUP_PERIOD}' > {cgroup_dir}/cpu.max",
+        ]
+        if CGROUP_CPUS is not None:
+            setup.append(f"echo {CGROUP_CPUS} > {cgroup_dir}/cpuset.cpus")
+        setup += [
+            f"for role in {roles}; do mkdir -p {cgroup_dir}/$role || exit 1; done",
+            f"cat {cgroup_dir}/cpu.max {cgroup_dir}/cpuset.cpus.effective",
+            "echo ok",
+        ]
+        script = "; ".join(cleanup + [" && ".join(setup)])
+        failed = []
+        for worker, output in zip(
+            self.workers,
+            self.exec_workers(f"sudo sh -c {shlex.quote(script)}", check=False),
+        ):
+            lines = output.splitlines()
+            if len(lines) < 3 or lines[-1] != "ok":
+                failed.append(worker.name)
+                continue
+            log.debug(
+                f"Agents on {worker.name} limited to {lines[0]} of CPUs {lines[1]}"
+            )
+        if len(failed) > 0:
+            log.error(f"Error setting cgroups on {failed}, falling back to ps")
+            self.cgroup = False
+            return
+        log.debug("Cgroups set")
+
+    # Runs a command on every worker and returns their outputs
+    def exec_workers(self, command, check=True):
+        outputs = []
+        for worker in self.workers:
+            _, stdout, _ = worker.ssh.exec_command(command, check=check)
+            outputs.append(stdout.read().decode())
+        return outputs
+
+    # Usage is reported for the busiest worker
     def get_load(self):
-        _, stdout, _ = self.ssh_worker.exec_command(
-            "awk '{ print $1 }' /proc/loadavg", check=True
+        return max(
+            float(output.strip())
+            for output in self.exec_workers("awk '{ print $1 }' /proc/loadavg")
         )
-        return float(stdout.read().decode().strip())
+
+    # Splits an agent count over the workers in proportion to their cores, giving
+    # the remainder to the workers with the largest fractional shares
+    def distribute(self, count):
+        cores = [worker.cores for worker in self.workers]
+        shares = [count * c / sum(cores) for c in cores]
+        counts = [int(share) for share in shares]
+        remainders = sorted(
+            range(len(shares)), key=lambda i: shares[i] - counts[i], reverse=True
+        )
+        for i in remainders[: count - sum(counts)]:
+            counts[i] += 1
+        return counts
 
     # --- Fluffi Web ---
 
+    def new_session(self):
+        return util.FaultTolerantSession(self)
+
     def new_fuzzjob(
         self,
         name_prefix,
@@ -255,33 +404,40 @@ class Instance:
         log.debug(f"Fuzzjob named {name} created with ID {fuzzjob.key}")
         return fuzzjob
 
-    def set_lm(self, num):
+    def set_lm(self, num, flush=True):
         log.debug(f"Setting LM to {num}...")
-        self.s.post(
-            f"{FLUFFI_URL}/systems/configureSystemInstances/{self.worker_name}",
-            files={
-                "localManager_lm": (None, num),
-                "localManager_lm_arch": (None, ARCH),
-            },
-            expect_str="Success!",
-        )
-        self.manage_agents()
+        for worker, lm in zip(self.workers, self.distribute(num)):
+            self.s.post(
+                f"{FLUFFI_URL}/systems/configureSystemInstances/{worker.name}",
+                files={
+                    "localManager_lm": (None, lm),
+                    "localManager_lm_arch": (None, ARCH),
+                },
+                expect_str="Success!",
+            )
+        self.agents_pending = True
+        if flush:
+            self.flush_agents()
         log.debug(f"LM set to {num}")
 
     # --- Polemarch ---
 
+    # Applies all queued LM and GRE changes with a single manage agents run
+    def flush_agents(self):
+        if self.agents_pending:
+            self.manage_agents()
+
     def manage_agents(self):
         log.debug("Starting manage agents task...")
-        s = util.FaultTolerantSession(self)
-        s.auth = ("admin", "admin")
-        r = s.post(
+        self.agents_pending = False
+        r = self.pm.post(
             f"{PM_URL}/project/1/periodic_task/3/execute/",
             expect_str="Started at inventory",
         )
         history_id = r.json()["history_id"]
         time.sleep(2)
         while True:
-            r = s.get(f"{PM_URL}/project/1/history/{history_id}")
+            r = self.pm.get(f"{PM_URL}/project/1/history/{history_id}")
             if r.json()["status"] == "OK":
                 break
             time.sleep(util.SLEEP_TIME)
@@ -298,3 +454,39 @@ class Instance:
             fuzzjobs.append(Fuzzjob(self, key, name))
         log.debug("Fuzzjobs fetched")
         return fuzzjobs
+
+    # Fuzzjobs that were archived but whose dumps were not retrieved yet
+    def get_archived_fuzzjobs(self):
+        log.debug("Fetching archived fuzzjobs...")
+        dump_path_fmt = DUMP_PATH_FMT.format(DB_FUZZJOB_FMT)
+        _, stdout, _ = self.ssh_master.exec_command(
+            f"ls {os.path.dirname(dump_path_fmt)}", check=True
+        )
+        dump_re = re.escape(os.path.basename(dump_path_fmt)).replace(r"\{\}", "(.+)")
+        fuzzjobs = []
+        for filename in stdout.read().decode().split():
+            m = re.fullmatch(dump_re, filename)
+            if m is not None:
+                log.debug(f"Found archived fuzzjob {m[1]}")
+                fuzzjobs.append(Fuzzjob(self, None, m[1]))
+        log.debug("Archived fuzzjobs fetched")
+        return fuzzjobs
+
+
+# Worker of a location that agents run on
+class Worker:
+    def __init__(self, n, i):
+        self.name = WORKER_NAME_FMT.format(n, i)
+        if i == 1:
+            self.hostname = SSH_WORKER_FMT.format(n)
+        else:
+            self.hostname = SSH_WORKER_EXTRA_FMT.format(n, i)
+
+    @functools.cached_property
+    def ssh(self):
+        return util.FaultTolerantSSHAndSFTPClient(self.hostname)
+
+    @functools.cached_property
+    def cores(self):
+        _, stdout, _ = self.ssh.exec_command("nproc", check=True)
+        return int(stdout.read().decode().strip())
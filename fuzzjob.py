@@ -1,21 +1,24 @@
+import collections
 import logging
+import os
 import re
+import shlex
 import time
 
+import controller
 import fluffi
 import util
 
 # Constants
 DB_FUZZJOB_FMT = "fluffi_{}"
 DUMP_PATH_FMT = "/srv/fluffi/data/ftp/files/archive/{}.sql.gz"
-ADJUST_AGENTS = False
+ADJUST_AGENTS = None  # None, "load", or "throughput"
 MANAGE_AGENTS_INTERVAL = 1 * 60  # 1 minute
-LOAD_HIGH = 15.8
-LOAD_LOW = 14.3
-LOAD_COUNTER_MIN = 6
 GEN_INIT = 2
 RUN_INIT = 15
 EVA_INIT = 15
+PRUNE_USAGE = 70  # percent of the RAM disk or disk used before pruning
+CAPTURE_PAGE = 10000  # rows per keyset page when capturing from the DB
 
 # Get logger
 log = logging.getLogger("fluffi")
@@ -28,15 +31,20 @@ class Fuzzjob:
         self.name = name
         self.db_name = DB_FUZZJOB_FMT.format(self.name)
         self.dump_path = DUMP_PATH_FMT.format(self.db_name)
+        self.start_time = time.time()
         self.gen = GEN_INIT
         self.run = RUN_INIT
         self.eva = EVA_INIT
         self.pid_cpu_time = {}
         self.dead_cpu_time = 0
+        self.cpu_time = 0
+        self.role_cpu_time = {}
+        self.premove_cpu_time = collections.Counter()
+        self.pruned_files = 0
+        self.pruned_bytes = 0
         self.last_manage_time = time.time()
         self.last_adjust_gre_time = time.time()
-        self.load_high_counter = 0
-        self.load_low_counter = 0
+        self.controller = controller.new(ADJUST_AGENTS)
 
     # --- SSH ---
 
@@ -44,24 +52,55 @@ class Fuzzjob:
         log.debug(f"Retrieving dump for fuzzjob {self.name}...")
         self.f.ssh_master.get(self.dump_path, local_path)
         if clean:
-            self.f.ssh_master.exec_command(f"rm {self.dump_path}", check=True)
+            self.remove_dump()
         log.debug(f"Retrieved dump for fuzzjob {self.name}")
 
+    def remove_dump(self):
+        self.f.ssh_master.exec_command(f"rm {self.dump_path}", check=True)
+
     def get_cpu_time(self):
         log.debug("Getting CPU time...")
+        if self.f.cgroup:
+            cpu_time_total, agents = self.get_cgroup_cpu_time()
+        else:
+            cpu_time_total, agents = self.get_ps_cpu_time()
+
+        # Attempt manage agents if incorrect number running
+        if (
+            agents != sum([fluffi.LM, self.gen, self.run, self.eva])
+            and (time.time() - self.last_manage_time) > MANAGE_AGENTS_INTERVAL
+        ):
+            log.warn(f"Incorrect number of agents ({agents}) are running")
+            self.f.manage_agents()
+            self.last_manage_time = time.time()
+
+        # Let the controller adjust GRE, load is sampled on every check
+        self.cpu_time = cpu_time_total
+        if self.controller is not None:
+            if (time.time() - self.last_manage_time) <= MANAGE_AGENTS_INTERVAL:
+                self.controller.reset()
+            elif self.controller.sample == "load":
+                self.adjust_gre({"cpu_time": cpu_time_total, "load": self.f.get_load()})
+
+        log.debug(f"Got CPU time of {cpu_time_total / 60:.2f} minutes")
+        return cpu_time_total
+
+    # Sums the cumulative CPU time of the agent processes, keeping the time of
+    # processes that died
+    def get_ps_cpu_time(self):
         cpu_time_total = 0
         pid_cpu_time = {}
 
-        # Get the new PIDs and time
-        _, stdout, _ = self.f.ssh_worker.exec_command(
+        # Get the new PIDs and time on every worker
+        outputs = self.f.exec_workers(
             f"ps --cumulative -ax | grep {self.f.location} "
-            f"| grep -v grep | awk '{{print $1, $4}}'",
-            check=True,
+            f"| grep -v grep | awk '{{print $1, $4}}'"
         )
-        for match in re.findall(r"(\d+) (\d+):(\d+)", stdout.read().decode()):
-            pid, mins, secs = map(int, match)
-            pid_cpu_time[pid] = (mins * 60) + secs
-            cpu_time_total += pid_cpu_time[pid]
+        for worker, output in zip(self.f.workers, outputs):
+            for match in re.findall(r"(\d+) (\d+):(\d+)", output):
+                pid, mins, secs = map(int, match)
+                pid_cpu_time[(worker.name, pid)] = (mins * 60) + secs
+                cpu_time_total += pid_cpu_time[(worker.name, pid)]
         agents = len(pid_cpu_time) // 2
 
         # Check for any dead processes
@@ -71,49 +110,83 @@ class Fuzzjob:
                 self.dead_cpu_time += cpu_time
         cpu_time_total += self.dead_cpu_time
         self.pid_cpu_time = pid_cpu_time
+        return cpu_time_total, agents
 
-        # Attempt manage agents if incorrect number running
-        if (
-            agents != sum([fluffi.LM, self.gen, self.run, self.eva])
-            and (time.time() - self.last_manage_time) > MANAGE_AGENTS_INTERVAL
-        ):
-            log.warn(f"Incorrect number of agents ({agents}) are running")
-            self.f.manage_agents()
-            self.last_manage_time = time.time()
+    # Moves new agent processes and their descendants, like targets run under
+    # drrun, into their role's cgroup, where CPU time is kept even after they exit.
+    # Time a process used before it was moved is read from /proc just before it
+    # moves and only counted once the move succeeded. Not counted are the ticks
+    # between that read and the move, and processes forked outside the cgroup
+    # that exit before the next poll moves them.
+    def get_cgroup_cpu_time(self):
+        cgroup = fluffi.CGROUP_FMT.format(self.f.location)
+        cgroup_dir = os.path.join(fluffi.CGROUP_ROOT, cgroup)
+        script = [
+            f"ps -ax | grep {self.f.location} | grep -v grep | awk '{{print \"ps\"}}'",
+            "tree() { echo $1; for child in $(pgrep -P $1); do tree $child; done; }",
+        ]
 
-        # Adjust GRE based on load
-        if (
-            ADJUST_AGENTS
-            and (time.time() - self.last_manage_time) > MANAGE_AGENTS_INTERVAL
-        ):
-            load = self.f.get_load()
-            if load > LOAD_HIGH:
-                self.load_high_counter += 1
-                self.load_low_counter = 0
-                if self.load_high_counter >= LOAD_COUNTER_MIN:
-                    self.run -= 1
-                    self.eva -= 1
-                    log.warn(f"Decreasing RE agents to {self.run}")
-                    self.set_gre()
-                    self.load_high_counter = 0
-            elif load < LOAD_LOW:
-                self.load_high_counter = 0
-                self.load_low_counter += 1
-                if self.load_low_counter >= LOAD_COUNTER_MIN:
-                    self.run += 1
-                    self.eva += 1
-                    log.warn(f"Increasing RE agents to {self.run}")
-                    self.set_gre()
-                    self.load_low_counter = 0
-            else:
-                self.load_high_counter = 0
-                self.load_low_counter = 0
-        else:
-            self.load_high_counter = 0
-            self.load_low_counter = 0
+        # Agents are moved before the local manager, whose tree is left with
+        # processes already in a group if it spawns any of them
+        for role, binary in reversed(fluffi.CGROUP_ROLES.items()):
+            script += [
+                f"for pid in $(pgrep -f '[{binary[0]}]{binary[1:]}'); do "
+                "for p in $(tree $pid); do "
+                f"grep -q '^0::/{cgroup}/' /proc/$p/cgroup || "
+                "{ stat=$(cut -d ' ' -f 14-17 /proc/$p/stat) && "
+                f"echo $p > {cgroup_dir}/{role}/cgroup.procs && "
+                f"echo moved {role} $stat; }}; done; done",
+                f"echo usage {role} $(grep usage_usec {cgroup_dir}/{role}/cpu.stat "
+                "| cut -d ' ' -f 2)",
+            ]
+        outputs = self.f.exec_workers(
+            f"sudo sh -c {shlex.quote('; '.join(script))} 2>/dev/null", check=False
+        )
 
-        log.debug(f"Got CPU time of {cpu_time_total / 60:.2f} minutes")
-        return cpu_time_total
+        # Usage is summed over the workers
+        processes = 0
+        role_cpu_time = collections.Counter()
+        for output in outputs:
+            for line in output.splitlines():
+                fields = line.split()
+                if fields == ["ps"]:
+                    processes += 1
+                elif len(fields) == 6 and fields[0] == "moved":
+                    ticks = sum(map(int, fields[2:]))
+                    self.premove_cpu_time[fields[1]] += ticks / fluffi.CLK_TCK
+                elif len(fields) == 3 and fields[0] == "usage":
+                    role_cpu_time[fields[1]] += int(fields[2]) / 1000000
+        self.role_cpu_time = {
+            role: role_cpu_time[role] + self.premove_cpu_time[role]
+            for role in fluffi.CGROUP_ROLES
+        }
+        cpu_time_total = sum(self.role_cpu_time.values()) + self.dead_cpu_time
+        return cpu_time_total, processes // 2
+
+    # Restores state from the last recorded stats row of a running fuzzjob
+    # The start time persisted with the stats survives restarts, without it only
+    # the sampled real time is known
+    def reattach(self, row=None, start_time=None):
+        log.debug(f"Reattaching to fuzzjob {self.name}...")
+        if start_time is not None:
+            self.start_time = start_time
+        elif row is not None:
+            self.start_time = time.time() - row["real_time"]
+        if row is not None:
+            self.gen = int(row.get("gen", self.gen))
+            self.run = int(row.get("run", self.run))
+            self.eva = int(row.get("eva", self.eva))
+            self.pruned_files = int(row.get("pruned_files", self.pruned_files))
+            self.pruned_bytes = int(row.get("pruned_bytes", self.pruned_bytes))
+        cpu_time = self.get_cpu_time()
+
+        # Time of agents that died while detached is recovered from the stats
+        if row is not None and row["cpu_time"] > cpu_time:
+            self.dead_cpu_time = row["cpu_time"] - cpu_time
+        log.debug(
+            f"Reattached to fuzzjob {self.name} with GRE {self.gen}, {self.run}, "
+            f"{self.eva} and {self.dead_cpu_time} seconds of dead CPU time"
+        )
 
     # --- Fluffi Web ---
 
@@ -144,25 +217,40 @@ class Fuzzjob:
         time.sleep(5)
         log.debug(f"Fuzzjob {self.name} archived")
 
-    def set_gre(self, down=False):
+    def adjust_gre(self, sample):
+        gre = self.controller.decide((self.gen, self.run, self.eva), sample)
+        if gre != (self.gen, self.run, self.eva):
+            self.gen, self.run, self.eva = gre
+            self.set_gre()
+
+    def set_gre(self, down=False, flush=True):
         gen = 0 if down else self.gen
         run = 0 if down else self.run
         eva = 0 if down else self.eva
         log.debug(f"Setting GRE to {gen}, {run}, {eva} for {self.name}...")
+        files = {}
+        for worker, worker_gen, worker_run, worker_eva in zip(
+            self.f.workers,
+            self.f.distribute(gen),
+            self.f.distribute(run),
+            self.f.distribute(eva),
+        ):
+            files[f"{worker.name}_tg"] = (None, worker_gen)
+            files[f"{worker.name}_tg_arch"] = (None, fluffi.ARCH)
+            files[f"{worker.name}_tr"] = (None, worker_run)
+            files[f"{worker.name}_tr_arch"] = (None, fluffi.ARCH)
+            files[f"{worker.name}_te"] = (None, worker_eva)
+            files[f"{worker.name}_te_arch"] = (None, fluffi.ARCH)
         self.f.s.post(
             f"{fluffi.FLUFFI_URL}/systems/configureFuzzjobInstances/{self.name}",
-            files={
-                f"{self.f.worker_name}_tg": (None, gen),
-                f"{self.f.worker_name}_tg_arch": (None, fluffi.ARCH),
-                f"{self.f.worker_name}_tr": (None, run),
-                f"{self.f.worker_name}_tr_arch": (None, fluffi.ARCH),
-                f"{self.f.worker_name}_te": (None, eva),
-                f"{self.f.worker_name}_te_arch": (None, fluffi.ARCH),
-            },
+            files=files,
             expect_str="Success!",
         )
-        self.f.manage_agents()
-        self.last_manage_time = time.time()
+        self.f.agents_pending = True
+        # Agents only change once flushed, until then the last manage time stands
+        if flush:
+            self.f.flush_agents()
+            self.last_manage_time = time.time()
         log.debug(f"GRE set to {gen}, {run}, {eva} for {self.name}")
 
     # --- DB ---
@@ -175,6 +263,42 @@ class Fuzzjob:
         log.debug(f"Got {testcases} testcases for {self.name}")
         return testcases
 
+    # Pages through the rows of a query ordered by key, starting after last
+    def get_rows_after(self, query, key, last):
+        rows = []
+        while True:
+            where = f"{key} > '{last}'" if isinstance(last, str) else f"{key} > {last}"
+            page = self.f.db.query_all(
+                f"{query} WHERE {where} ORDER BY {key} LIMIT {CAPTURE_PAGE}",
+                self.db_name,
+            )
+            rows += page
+            if len(page) < CAPTURE_PAGE:
+                return rows
+            last = page[-1][0]
+
+    def get_new_covered_blocks(self, last_id):
+        return self.get_rows_after(
+            "SELECT ID, Offset, TimeOfInsertion FROM covered_blocks", "ID", last_id
+        )
+
+    # Crashes are timed by the testcase that caused them
+    def get_new_crashes(self, last_id):
+        return self.get_rows_after(
+            "SELECT c.ID, c.CreatorTestcaseID, c.CrashFootprint, t.TimeOfInsertion "
+            "FROM crash_descriptions c "
+            "LEFT JOIN interesting_testcases t ON t.ID = c.CreatorTestcaseID",
+            "c.ID",
+            last_id,
+        )
+
+    # Edge coverage has no ID and its counters change, so all of it is paged
+    # through by hash
+    def get_paths(self):
+        return self.get_rows_after(
+            "SELECT hash, counter FROM edge_coverage", "hash", ""
+        )
+
     # --- Data Collection ---
 
     def get_stats(self):
@@ -197,41 +321,69 @@ class Fuzzjob:
         d["no_response"] = int(matches[7])
         d["covered_blocks"] = int(matches[8])
 
+        # Agent counts, needed to restore the fuzzjob when reattaching
+        d["gen"] = self.gen
+        d["run"] = self.run
+        d["eva"] = self.eva
+
         # Edge coverage from DB
         d["paths"] = self.f.db.query_one(
             "SELECT COUNT(*) FROM edge_coverage", self.db_name
         )[0]
 
-        # Load average
+        # Load average, usage below is for the busiest worker
         d["load"] = self.f.get_load()
         if d["load"] > 17:
             log.warn(f"Load average is at {d['load']}")
 
         # RAM usage
-        _, stdout, _ = self.f.ssh_worker.exec_command(
-            "free | grep Mem | awk '{print $3/$2 * 100.0}'", check=True
+        d["memory_used"] = max(
+            float(output.strip())
+            for output in self.f.exec_workers(
+                "free | grep Mem | awk '{print $3/$2 * 100.0}'"
+            )
         )
-        d["memory_used"] = float(stdout.read().decode().strip())
         if d["memory_used"] > 80:
             log.warn(f"Memory usage is at {d['memory_used']}%")
 
         # Disk usage
-        _, stdout, _ = self.f.ssh_worker.exec_command(
-            "df / | tail -n +2 | awk '{ print $5 }'", check=True
+        d["disk_used"] = max(
+            int(output.strip()[:-1])
+            for output in self.f.exec_workers("df / | tail -n +2 | awk '{ print $5 }'")
         )
-        d["disk_used"] = int(stdout.read().decode().strip()[:-1])
         if d["disk_used"] > 70:
             log.warn(f"Disk usage is at {d['disk_used']}%")
 
         # RAM disk usage
-        _, stdout, _ = self.f.ssh_worker.exec_command(
-            "df /home/fluffi_linux_user/fluffi/ramdisk "
-            "| tail -n +2 | awk '{ print $5 }'",
-            check=True,
+        d["ramdisk_used"] = max(
+            int(output.strip()[:-1])
+            for output in self.f.exec_workers(
+                "df /home/fluffi_linux_user/fluffi/ramdisk "
+                "| tail -n +2 | awk '{ print $5 }'"
+            )
         )
-        d["ramdisk_used"] = int(stdout.read().decode().strip()[:-1])
         if d["ramdisk_used"] > 70:
             log.warn(f"RAM disk usage is at {d['ramdisk_used']}%")
 
+        # Prune the workers under pressure, totals are kept with the stats
+        if d["ramdisk_used"] > PRUNE_USAGE or d["disk_used"] > PRUNE_USAGE:
+            files, size = self.f.prune()
+            self.pruned_files += files
+            self.pruned_bytes += size
+        d["pruned_files"] = self.pruned_files
+        d["pruned_bytes"] = self.pruned_bytes
+
+        # CPU time per agent role, from the cgroups
+        for role, cpu_time in self.role_cpu_time.items():
+            d[f"cpu_time_{role}"] = cpu_time
+
+        # Let the controller adjust GRE on throughput
+        if (
+            self.controller is not None
+            and self.controller.sample == "stats"
+            and (time.time() - self.last_manage_time) > MANAGE_AGENTS_INTERVAL
+        ):
+            self.adjust_gre(dict(d, cpu_time=self.cpu_time))
+
         log.debug(f"Got stats for {self.name}")
         return d
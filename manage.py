@@ -6,6 +6,7 @@ import os
 import subprocess
 
 import fluffi
+import replay
 
 # Constants
 N_MIN = 5
@@ -26,6 +27,11 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("command", type=str, help="clone, up, down, deploy, or all")
     parser.add_argument("-n", type=int, help=f"{N_MIN}-{N_MAX} or omit for all")
+    parser.add_argument("-t", type=str, help="record client calls to a trace file")
+    parser.add_argument("-p", type=str, help="replay client calls from a trace file")
+    parser.add_argument(
+        "-x", type=float, default=0, help="real seconds per replayed second (0)"
+    )
     args = parser.parse_args()
 
     # Check host
@@ -33,6 +39,12 @@ def main():
         print("Invalid host")
         exit(1)
 
+    # Record or replay client calls
+    if args.t is not None:
+        replay.record(args.t)
+    elif args.p is not None:
+        replay.replay(args.p, scale=args.x)
+
     # Setup up args
     with open(os.path.join(FUZZGOAT_PATH, "fuzzgoat"), "rb") as f:
         data = f.read()
@@ -116,4 +128,8 @@ def clone(n):
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except replay.TraceEnd as e:
+        log.info(f"Replay ended: {e}")
+    replay.log_summary()
@@ -0,0 +1,129 @@
+import http.server
+import logging
+import threading
+import time
+
+# Constants
+METRICS_ADDR = "127.0.0.1"
+METRICS_PORT = 9200  # plus the server number
+STATS_GAUGES = {
+    "completed_testcases": "Testcases completed by the fuzzjob",
+    "covered_blocks": "Basic blocks covered by the fuzzjob",
+    "paths": "Edge coverage paths found by the fuzzjob",
+    "crashes_total": "Crashes found by the fuzzjob",
+    "crashes_unique": "Unique crashes found by the fuzzjob",
+    "access_violations_total": "Access violations found by the fuzzjob",
+    "access_violations_unique": "Unique access violations found by the fuzzjob",
+    "hangs": "Hangs found by the fuzzjob",
+    "load": "Load average of the busiest worker",
+    "memory_used": "Percent of memory used on the busiest worker",
+    "disk_used": "Percent of disk used on the busiest worker",
+    "ramdisk_used": "Percent of the RAM disk used on the busiest worker",
+    "pruned_bytes": "Bytes pruned from the workers during the trial",
+}
+
+# Get logger
+log = logging.getLogger("fluffi")
+
+
+# Read-only Prometheus text endpoint for the trial running on one location, fed
+# with what the trial loop already collects
+class Exporter:
+    def __init__(self, location, port, trial_time):
+        self.location = location
+        self.trial_time = trial_time
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.trial = {}
+        self.last_row = None
+
+        # Serve HTTP in the background, the experiment runs on without it
+        handler = type("Handler", (Handler,), {"exporter": self})
+        try:
+            self.server = http.server.ThreadingHTTPServer((METRICS_ADDR, port), handler)
+        except OSError as e:
+            log.error(f"Error serving metrics on port {port}: {e}")
+            self.server = None
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"Serving metrics on http://{METRICS_ADDR}:{port}/metrics")
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set(self, name, help, value):
+        with self.lock:
+            self.gauges[name] = (help, value)
+
+    # Clears the gauges so nothing from the previous trial is served as current
+    def set_trial(self, benchmark, trial):
+        with self.lock:
+            self.trial = {"benchmark": benchmark, "trial": trial}
+            self.gauges = {}
+            self.last_row = None
+        self.set("trial_time_seconds", "CPU time budget of a trial", self.trial_time)
+
+    def observe_cpu_time(self, cpu_time, rate):
+        self.set("cpu_time_seconds", "CPU time used by the trial", cpu_time)
+        self.set("cpu_rate", "CPU seconds accrued per real second", rate or 0)
+        self.set(
+            "eta_seconds",
+            "Real time until the trial's CPU time runs out",
+            max(self.trial_time - cpu_time, 0) / rate if rate else float("nan"),
+        )
+        self.set("last_poll_timestamp_seconds", "Time of the last poll", time.time())
+
+    def observe_stats(self, row):
+        for key, help in STATS_GAUGES.items():
+            if key in row:
+                self.set(key, help, row[key])
+        if self.last_row is not None and row["real_time"] > self.last_row["real_time"]:
+            self.set(
+                "testcases_per_second",
+                "Testcases completed per real second since the last stats sample",
+                (row["completed_testcases"] - self.last_row["completed_testcases"])
+                / (row["real_time"] - self.last_row["real_time"]),
+            )
+        self.last_row = row
+
+    def render(self):
+        labels = f'location="{self.location}"'
+        lines = []
+        with self.lock:
+            if len(self.trial) > 0:
+                trial_labels = "".join(
+                    f',{key}="{value}"' for key, value in self.trial.items()
+                )
+                lines += [
+                    "# HELP fluffi_trial_info Trial currently running",
+                    "# TYPE fluffi_trial_info gauge",
+                    f"fluffi_trial_info{{{labels}{trial_labels}}} 1",
+                ]
+            for name, (help, value) in sorted(self.gauges.items()):
+                lines += [
+                    f"# HELP fluffi_{name} {help}",
+                    f"# TYPE fluffi_{name} gauge",
+                    f"fluffi_{name}{{{labels}}} {float(value)}",
+                ]
+        return "\n".join(lines) + "\n"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    exporter = None
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        data = self.exporter.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
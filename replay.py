@@ -0,0 +1,243 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+# Constants
+TRACE_ENCODING = "utf-8"
+
+# Get logger
+log = logging.getLogger("fluffi")
+
+# Active recorder or player, at most one is set by record() or replay()
+recorder = None
+player = None
+
+
+# Raised when a replayed call has no recorded responses left
+class TraceEnd(Exception):
+    pass
+
+
+def record(path):
+    global recorder
+    recorder = Recorder(path)
+    log.info(f"Recording client calls to {path}")
+
+
+def replay(path, scratch_dir=None, scale=1.0):
+    global player
+    player = Player(path, scratch_dir, scale)
+    player.install()
+    log.info(f"Replaying {len(player.entries)} client calls from {path}")
+
+
+# Runs a client call through the active recorder or player. Recorded calls also
+# return the loaded response, so the recording run sees what a replay would.
+def call(op, key, func, dump, load):
+    if player is not None:
+        return load(player.next(op, key))
+    elif recorder is None:
+        return func()
+    start = time.time()
+    response = dump(func())
+    recorder.write(op, key, response, start, time.time() - start)
+    return load(response)
+
+
+# Writes one JSON line per call, flushed so a killed run keeps its trace. An
+# existing trace is never appended to, as calls of two runs would be mixed.
+class Recorder:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.f = open(path, "x", encoding=TRACE_ENCODING)
+
+    def write(self, op, key, response, start, latency):
+        line = json.dumps(
+            {
+                "op": op,
+                "key": key,
+                "response": response,
+                "time": start,
+                "latency": latency,
+            },
+            default=str,
+        )
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+
+
+# Serves recorded responses on a virtual clock that advances by the recorded
+# latencies and the requested sleeps, sleeping scale times as long in real time.
+# Replayed downloads are only written under the scratch directory.
+class Player:
+    def __init__(self, path, scratch_dir=None, scale=1.0):
+        self.scratch_dir = None if scratch_dir is None else os.path.abspath(scratch_dir)
+        self.scale = scale
+        self.lock = threading.Lock()
+        with open(path, encoding=TRACE_ENCODING) as f:
+            self.entries = [json.loads(line) for line in f if line.strip()]
+        self.by_key = collections.defaultdict(collections.deque)
+        self.by_op = collections.defaultdict(collections.deque)
+        for i, entry in enumerate(self.entries):
+            self.by_key[self.key(entry["op"], entry["key"])].append(i)
+            self.by_op[entry["op"]].append(i)
+        self.served = set()
+        self.calls = collections.Counter()
+        self.latency = collections.Counter()
+        self.slept = 0
+        self.now = self.entries[0]["time"] if len(self.entries) > 0 else time.time()
+        self.real_sleep = time.sleep
+        self.start = time.perf_counter()
+
+    @staticmethod
+    def key(op, key):
+        return op, json.dumps(key, sort_keys=True)
+
+    # Replaces the clock for the whole process, so polling loops and names
+    # derived from the time follow the recording
+    def install(self):
+        time.time = self.time
+        time.sleep = self.sleep
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+            self.slept += seconds
+        self.real_sleep(seconds * self.scale)
+
+    # Calls are matched on their key in recorded order. Keys never recorded, like
+    # URLs with a differently timed fuzzjob name, take the next call of the op.
+    def next(self, op, key):
+        with self.lock:
+            k = self.key(op, key)
+            queue = self.by_key[k] if k in self.by_key else self.by_op[op]
+            while len(queue) > 0 and queue[0] in self.served:
+                queue.popleft()
+            if len(queue) == 0:
+                raise TraceEnd(f"No recorded responses left for {op} {key}")
+            i = queue.popleft()
+            self.served.add(i)
+            entry = self.entries[i]
+            self.calls[op] += 1
+            self.latency[op] += entry["latency"]
+            self.now += entry["latency"]
+        self.real_sleep(entry["latency"] * self.scale)
+        return entry["response"]
+
+    def summary(self):
+        return {
+            "calls": dict(self.calls),
+            "latency": dict(self.latency),
+            "slept": self.slept,
+            "unserved": len(self.entries) - len(self.served),
+            "wall_time": time.perf_counter() - self.start,
+        }
+
+
+# Logs what a replay served, the basis for comparing orchestration changes
+def log_summary():
+    if player is None:
+        return
+    summary = player.summary()
+    for op in sorted(summary["calls"]):
+        log.info(
+            f"Replayed {summary['calls'][op]} {op} calls with "
+            f"{summary['latency'][op]:.2f} seconds of recorded latency"
+        )
+    log.info(
+        f"Replay took {summary['wall_time']:.2f} seconds and slept "
+        f"{summary['slept']:.2f} virtual seconds, "
+        f"{summary['unserved']} recorded calls were not made"
+    )
+
+
+# --- Responses ---
+
+
+# SSH output, read eagerly and standing in for paramiko's channel files
+class Output:
+    def __init__(self, data=b"", status=0):
+        self.data = data
+        self.status = status
+        self.channel = self
+
+    def read(self):
+        return self.data
+
+    def recv_exit_status(self):
+        return self.status
+
+
+def dump_output(result):
+    _, stdout, stderr = result
+    return {
+        "stdout": stdout.read().decode(TRACE_ENCODING, "surrogateescape"),
+        "stderr": stderr.read().decode(TRACE_ENCODING, "surrogateescape"),
+        "status": stdout.channel.recv_exit_status(),
+    }
+
+
+def load_output(response):
+    status = response["status"]
+    return (
+        None,
+        Output(response["stdout"].encode(TRACE_ENCODING, "surrogateescape"), status),
+        Output(response["stderr"].encode(TRACE_ENCODING, "surrogateescape"), status),
+    )
+
+
+def dump_response(r):
+    return {
+        "status": r.status_code,
+        "url": r.url,
+        "headers": dict(r.headers),
+        "content": r.content.decode(TRACE_ENCODING, "surrogateescape"),
+    }
+
+
+def load_response(response):
+    r = requests.Response()
+    r.status_code = response["status"]
+    r.url = response["url"]
+    r.headers.update(response["headers"])
+    r._content = response["content"].encode(TRACE_ENCODING, "surrogateescape")
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    return r
+
+
+# Rows come back as tuples like pymysql returns them
+def load_row(response):
+    return None if response is None else tuple(response)
+
+
+def load_rows(response):
+    return tuple(tuple(row) for row in response)
+
+
+# Transfers only keep the size of the local file, a replayed download leaves a
+# sparse file in its place, which must not land among real results
+def dump_file(local_path):
+    return os.path.getsize(local_path)
+
+
+# Recorded downloads are already in place
+def load_file(local_path, size):
+    if player is None:
+        return
+    local_path = os.path.abspath(local_path)
+    scratch_dir = player.scratch_dir
+    if scratch_dir is None or os.path.commonpath([local_path, scratch_dir]) != (
+        scratch_dir
+    ):
+        raise ValueError(f"Replayed download {local_path} is outside the scratch dir")
+    with open(local_path, "ab") as f:
+        f.truncate(size)
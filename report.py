@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import itertools
+import logging
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy.stats import mannwhitneyu
+
+import experiment
+import extract
+
+# Constants
+CACHE_DIR = ".cache/"
+REPORT_DIR = "report/"
+BOOTSTRAP_SAMPLES = 1000
+BOOTSTRAP_CI = 95
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_CHUNK = 2**24  # resampled values held in memory at once
+SIGNIFICANCE_STEPS = 30
+SIGNIFICANCE_ALPHA = 0.05
+SIGNIFICANCE_Y_KEY = "covered_blocks"
+SCORE_STEPS = 180
+SCORE_Y_KEY = "paths_exec"
+SCORE_XLIMS = {
+    "paths": (70, 80),
+    "paths_exec": (72, 82),
+    "covered_blocks": (90, 96),
+    "covered_blocks_exec": (80, 86),
+    "bugs": (30, 34),
+    "completed_testcases": (90, 92.5),
+}
+PLOT_Y_KEYS = ["covered_blocks", "paths"]
+PALETTE = {
+    "Constant / FLUFFI": "#6f4e7b",
+    "FAST / FLUFFI": "#c9472f",
+    "Constant / Round-Robin": "#ffa056",
+    "FAST / Round-Robin": "#f7c860",
+    "Constant / AFLFast": "#9dd766",
+    "FAST / AFLFast": "#267895",
+}  # 8dddd0
+HUE_ORDERS = {
+    "covered_blocks": [
+        "FAST / AFLFast",
+        "Constant / FLUFFI",
+        "Constant / AFLFast",
+        "FAST / FLUFFI",
+        "FAST / Round-Robin",
+        "Constant / Round-Robin",
+    ],
+    "paths": [
+        "FAST / AFLFast",
+        "Constant / AFLFast",
+        "Constant / FLUFFI",
+        "FAST / FLUFFI",
+        "FAST / Round-Robin",
+        "Constant / Round-Robin",
+    ],
+}
+Y_KEY_LABELS = {
+    "paths": "# Paths Covered",
+    "covered_blocks": "# Blocks Covered",
+    "crashes_unique": "# Crashes Found",
+}
+
+# Get logger
+log = logging.getLogger("fluffi")
+
+
+def main():
+    # Setup logging
+    log.setLevel(logging.INFO)
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", type=str, default=REPORT_DIR, help="report directory")
+    parser.add_argument(
+        "-y", type=str, default=SCORE_Y_KEY, help="metric for scores and ranks"
+    )
+    parser.add_argument(
+        "-s", type=int, default=SCORE_STEPS, help="time steps for scores and ranks"
+    )
+    args = parser.parse_args()
+
+    # Run the pipeline and write the report
+    plt.switch_backend("Agg")
+    results = run(extract.load("measurements"), score_y_key=args.y, score_steps=args.s)
+    write_report(results, args.o)
+
+
+# --- Pipeline ---
+
+
+# Runs every stage, each benchmark's results are cached separately so new trials
+# or changed parameters only recompute the stages and benchmarks they affect
+def run(
+    df_measurements,
+    significance_y_key=SIGNIFICANCE_Y_KEY,
+    significance_steps=SIGNIFICANCE_STEPS,
+    score_y_key=SCORE_Y_KEY,
+    score_steps=SCORE_STEPS,
+    plot_y_keys=PLOT_Y_KEYS,
+):
+    slices = {
+        benchmark: (hash_inputs(df), df)
+        for benchmark, df in df_measurements.groupby("benchmark", observed=True)
+    }
+    derived = stage("derived", slices, derive)
+    results = {"derived": concat(derived)}
+    results["significance"] = concat(
+        stage(
+            "significance",
+            stage("maxima", derived, maxima, significance_steps),
+            significance,
+            significance_y_key,
+        )
+    )
+    results["wins"] = wins(results["significance"])
+    results["scores"] = scores(
+        concat(
+            stage(
+                "medians",
+                stage("maxima", derived, maxima, score_steps),
+                medians,
+                score_y_key,
+            )
+        )
+    )
+    results["score_y_key"] = score_y_key
+    for y_key in plot_y_keys:
+        results[f"median_ci-{y_key}"] = pd.concat(
+            [median_ci(df, y_key, x="cpu_hours_round") for _, df in derived.values()],
+            ignore_index=True,
+        )
+    results["plot_y_keys"] = plot_y_keys
+    results["bugs"] = (
+        results["derived"].groupby("benchmark", observed=True)["bugs"].max()
+    )
+    return results
+
+
+# Hashes the columns of a DataFrame together with any parameters
+def hash_inputs(df, *params):
+    h = hashlib.sha256()
+    h.update(repr(list(df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    h.update(repr(params).encode())
+    return h.hexdigest()[:16]
+
+
+def hash_params(*params):
+    return hashlib.sha256(repr(params).encode()).hexdigest()[:16]
+
+
+# Returns the cached DataFrame for a key, computing and saving it on a miss
+def cached(name, key, func):
+    path = os.path.join(CACHE_DIR, f"{name}-{key}.parquet")
+    if os.path.isfile(path):
+        return pd.read_parquet(path)
+    log.info(f"Computing {name}...")
+    df = func()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    df.to_parquet(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+    return df
+
+
+# Applies a stage to each benchmark's (key, DataFrame) slice, keying each result
+# by its input's key and the parameters so keys chain through the stages
+def stage(name, slices, func, *params):
+    results = {}
+    for benchmark, (key, df) in slices.items():
+        stage_key = hash_params(key, name, *params)
+        results[benchmark] = (
+            stage_key,
+            cached(f"{name}-{benchmark}", stage_key, lambda: func(df, *params)),
+        )
+    return results
+
+
+def concat(slices):
+    return pd.concat([df for _, df in slices.values()], ignore_index=True)
+
+
+# --- Stages ---
+
+
+def derive(df):
+    df = df.copy()
+    df["cpu_seconds_round"] = df["cpu_time"].round(-3)
+    df["cpu_hours_round"] = df["cpu_seconds_round"] / 3600
+    df["bugs"] = df["crashes_unique"] + df["access_violations_unique"]
+    df["covered_blocks_exec"] = df["covered_blocks"] / df["completed_testcases"]
+    df["paths_exec"] = df["paths"] / df["completed_testcases"]
+    return df
+
+
+# Last sample of each trial at or before each of the steps through the trial
+def maxima(df, steps):
+    dfs = []
+    for i in range(1, steps + 1):
+        trial_time = (experiment.TRIAL_TIME / steps) * i
+        df_lim = df.loc[df["cpu_time"] <= trial_time]
+        df_lim = df_lim.loc[
+            df_lim.groupby(["experiment", "benchmark", "trial"], observed=True)[
+                "cpu_time"
+            ].idxmax()
+        ]
+        dfs.append(df_lim.assign(trial_time=trial_time))
+    return pd.concat(dfs, ignore_index=True)
+
+
+# Mann-Whitney U test between each pair of experiments at each step
+def significance(df_max, y_key):
+    rows = []
+    for (trial_time, benchmark), df in df_max.groupby(
+        ["trial_time", "benchmark"], observed=True
+    ):
+        if df[y_key].max() == 0:
+            continue
+        for exp_x, exp_y in itertools.combinations(extract.EXPERIMENTS, 2):
+            x = df.loc[df["experiment"] == exp_x][y_key]
+            y = df.loc[df["experiment"] == exp_y][y_key]
+            try:
+                _, p = mannwhitneyu(x, y)
+            except ValueError:
+                p = np.nan
+            if p < SIGNIFICANCE_ALPHA:
+                winner = exp_x if x.mean() > y.mean() else exp_y
+            else:
+                winner = "Inconclusive"
+            rows.append((trial_time, benchmark, exp_x, exp_y, p, winner))
+    return pd.DataFrame(
+        rows, columns=["trial_time", "benchmark", "exp_x", "exp_y", "p", "winner"]
+    )
+
+
+# Benchmarks won by each experiment at each step
+def wins(df_significance):
+    df = df_significance.loc[df_significance["winner"] != "Inconclusive"]
+    df = df.groupby(["trial_time", "winner"]).size().rename("wins").reset_index()
+    return df.rename(columns={"winner": "experiment"})
+
+
+# Median of each experiment at each step, normalized to the best trial and ranked
+def medians(df_max, y_key):
+    df = (
+        df_max.groupby(["trial_time", "benchmark", "experiment"], observed=True)[y_key]
+        .median()
+        .rename("median")
+        .reset_index()
+    )
+    df_best = df_max.groupby("trial_time")[y_key].max().rename("best")
+    df = df.join(df_best, on="trial_time")
+    df = df.loc[df["best"] > 0]
+    df["score"] = (df["median"] / df["best"]) * 100.0
+    df["experiment"] = pd.Categorical(df["experiment"], extract.EXPERIMENTS)
+    df = df.sort_values(["trial_time", "experiment"])
+    df["rank"] = df.groupby("trial_time")["median"].rank(
+        method="first", ascending=False
+    )
+    df["experiment"] = df["experiment"].astype(str)
+    return df
+
+
+# Average normalized score and rank over all benchmarks at each step
+def scores(df_medians):
+    df = df_medians.groupby(["trial_time", "experiment"])[["score", "rank"]].sum()
+    df = (df / len(experiment.BENCHMARKS)).reset_index()
+    df["cpu_hours"] = df["trial_time"] / 3600
+    return df
+
+
+# Median and percentile bootstrap CI of y_key for each (experiment, benchmark, x)
+# group, cached by the hash of the input data and parameters
+def median_ci(
+    df,
+    y_key,
+    x="checkpoint",
+    by=("experiment", "benchmark"),
+    n_boot=BOOTSTRAP_SAMPLES,
+    ci=BOOTSTRAP_CI,
+    seed=BOOTSTRAP_SEED,
+):
+    df = df[[*by, x, y_key]]
+    key = hash_inputs(df, y_key, x, by, n_boot, ci, seed)
+    return cached(
+        f"median_ci-{y_key}",
+        key,
+        lambda: bootstrap_median(df, y_key, [*by, x], n_boot, ci, seed),
+    )
+
+
+# Resamples every group at once: values are padded into a (groups, trials) matrix
+# with NaN, which np.sort moves past each group's size so medians can be indexed
+def bootstrap_median(df, y_key, keys, n_boot, ci, seed):
+    df = df.dropna(subset=[y_key])
+    grouped = df.groupby(keys, observed=True, sort=True)
+    group_ids = grouped.ngroup().to_numpy()
+    sizes = grouped.size().to_numpy()
+    n_max = sizes.max() if len(sizes) > 0 else 0
+    order = np.argsort(group_ids, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    positions = np.arange(len(df)) - np.repeat(starts, sizes)
+    values = np.full((len(sizes), n_max), np.nan)
+    values[group_ids[order], positions] = df[y_key].to_numpy(dtype=float)[order]
+
+    # Median of the first size values of each sorted row
+    def median(sorted_values, sizes):
+        low = np.take_along_axis(sorted_values, ((sizes - 1) // 2)[..., None], -1)
+        high = np.take_along_axis(sorted_values, (sizes // 2)[..., None], -1)
+        return ((low + high) / 2)[..., 0]
+
+    # Bootstrap medians in chunks of groups
+    rng = np.random.default_rng(seed)
+    alpha = (100 - ci) / 2
+    bounds = np.empty((len(sizes), 2))
+    chunk = max(1, BOOTSTRAP_CHUNK // max(1, n_boot * n_max))
+    for start in range(0, len(sizes), chunk):
+        end = min(start + chunk, len(sizes))
+        chunk_sizes = sizes[start:end, None, None]
+        samples = (rng.random((end - start, n_boot, n_max)) * chunk_sizes).astype(
+            np.int64
+        )
+        resampled = np.where(
+            np.arange(n_max) < chunk_sizes,
+            values[np.arange(start, end)[:, None, None], samples],
+            np.nan,
+        )
+        medians = median(
+            np.sort(resampled, axis=-1),
+            np.broadcast_to(chunk_sizes[..., 0], (end - start, n_boot)),
+        )
+        bounds[start:end] = np.percentile(medians, [alpha, 100 - alpha], axis=1).T
+
+    df_result = grouped.size().reset_index()[keys]
+    df_result["median"] = median(np.sort(values, axis=-1), sizes)
+    df_result["ci_low"] = bounds[:, 0]
+    df_result["ci_high"] = bounds[:, 1]
+    return df_result
+
+
+# Draws precomputed medians with their CI bands, one line per experiment
+def plot_median_ci(ax, df, x, hue_order, palette):
+    for exp in hue_order:
+        df_exp = df.loc[df["experiment"] == exp].sort_values(x)
+        if len(df_exp) == 0:
+            continue
+        ax.plot(df_exp[x], df_exp["median"], color=palette[exp], label=exp)
+        ax.fill_between(
+            df_exp[x],
+            df_exp["ci_low"],
+            df_exp["ci_high"],
+            color=palette[exp],
+            alpha=0.2,
+        )
+    ax.legend(title=None)
+    return ax
+
+
+# --- Report ---
+
+
+# Writes the figures and tables for the pipeline results
+def write_report(results, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Coverage line plots for each benchmark
+    for y_key in results["plot_y_keys"]:
+        df_median_ci = results[f"median_ci-{y_key}"]
+        for benchmark, df in df_median_ci.groupby("benchmark", observed=True):
+            fig, ax = plt.subplots(figsize=(6, 4), dpi=100)
+            plot_coverage(ax, df, y_key)
+            fig.savefig(os.path.join(out_dir, f"{y_key}-{benchmark}.png"))
+            plt.close(fig)
+
+    # Score and rank plots
+    df_scores = results["scores"]
+    for key, label in [("score", "Average Normalized Score"), ("rank", "Average Rank")]:
+        fig, ax = plt.subplots(figsize=(6, 4), dpi=100)
+        plot_scores(ax, df_scores, key, label)
+        fig.savefig(os.path.join(out_dir, f"{key}.png"))
+        plt.close(fig)
+    fig, ax = plt.subplots(figsize=(6, 4), dpi=100)
+    plot_final_scores(ax, df_scores, results["score_y_key"])
+    fig.savefig(os.path.join(out_dir, "score_final.png"))
+    plt.close(fig)
+    fig, ax = plt.subplots(figsize=(6, 6), dpi=100)
+    plot_final_ranks(ax, df_scores)
+    fig.savefig(os.path.join(out_dir, "rank_final.png"))
+    plt.close(fig)
+
+    # Tables
+    df_scores.to_csv(os.path.join(out_dir, "scores.csv"), index=False)
+    results["significance"].to_csv(
+        os.path.join(out_dir, "significance.csv"), index=False
+    )
+    results["wins"].to_csv(os.path.join(out_dir, "wins.csv"), index=False)
+    with open(os.path.join(out_dir, "bugs.tex"), "w") as f:
+        for benchmark, val in sorted(results["bugs"].items()):
+            benchmark = benchmark.replace("_", r"{\_}")
+            f.write(rf"{benchmark} & {val} \\ \hline" + "\n")
+    log.info(f"Report written to {out_dir}")
+
+
+def plot_coverage(ax, df, y_key):
+    hue_order = HUE_ORDERS.get(y_key, extract.EXPERIMENTS)
+    plot_median_ci(ax, df, "cpu_hours_round", hue_order, PALETTE)
+    ax.set_xlim(0, 30)
+    ax.set_ylim(0)
+    ax.set_xlabel("CPU Hours")
+    ax.set_ylabel(Y_KEY_LABELS.get(y_key, y_key))
+    return ax
+
+
+def plot_scores(ax, df_scores, key, label):
+    df_final = df_scores.loc[df_scores["trial_time"] == df_scores["trial_time"].max()]
+    order = df_final.sort_values(key, ascending=False)["experiment"]
+    for exp in order:
+        df = df_scores.loc[df_scores["experiment"] == exp]
+        ax.plot(df["cpu_hours"], df[key], color=PALETTE[exp], label=exp)
+    ax.legend(title=None)
+    ax.set_xlim(0, 30)
+    ax.set_xlabel("CPU Hours")
+    ax.set_ylabel(label)
+    return ax
+
+
+def plot_final_scores(ax, df_scores, y_key):
+    df_final = df_scores.loc[df_scores["trial_time"] == df_scores["trial_time"].max()]
+    df_final = df_final.sort_values("score", ascending=False)
+    ax.barh(
+        df_final["experiment"],
+        df_final["score"],
+        color=[PALETTE[exp] for exp in df_final["experiment"]],
+    )
+    ax.invert_yaxis()
+    if y_key in SCORE_XLIMS:
+        ax.set_xlim(*SCORE_XLIMS[y_key])
+    ax.set_xlabel("Average Normalized Score")
+    return ax
+
+
+# Best rank on top
+def plot_final_ranks(ax, df_scores):
+    df_final = df_scores.loc[df_scores["trial_time"] == df_scores["trial_time"].max()]
+    df_final = df_final.sort_values("rank")
+    ax.barh(
+        df_final["experiment"],
+        df_final["rank"],
+        color=[PALETTE[exp] for exp in df_final["experiment"]],
+    )
+    ax.invert_yaxis()
+    ax.set_xlim(1, 5)
+    ax.set_xlabel("Average Rank")
+    return ax
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+import collections
+import gzip
+import http.server
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import pandas as pd
+import requests
+
+import experiment
+import fluffi
+import fuzzjob
+import util
+
+# Constants
+SPEEDUP = 1.0  # CPU seconds each agent process accrues per real second
+PROCESSES_PER_AGENT = 2
+GROWTH_TIME = 10 * 60 * 60  # 10 hours in CPU time
+EXECS_PER_CPU_SECOND = 50
+BLOCKS_MAX = 20000
+PATHS_MAX = 100000
+CRASHES_MAX = 50
+MODULE_ID = 1
+ROWS_PER_INSERT = 1000
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+SYNTHETIC_ROWS = {
+    "interesting_testcases": 10000,
+    "covered_blocks": 200000,
+    "edge_coverage": 100000,
+    "crash_descriptions": 2000,
+}
+SYNTHETIC_BLOCK_RATIO = 0.2  # unique offsets per covered_blocks row
+SYNTHETIC_CRASH_RATIO = 0.05  # unique descriptions per crash_descriptions row
+SYNTHETIC_TESTCASE_SIZE = 1024
+SYNTHETIC_REAL_TIME = 16 * 60 * 60  # 16 hours of wall time for a trial
+TABLES = {
+    "interesting_testcases": [
+        ("ID", "bigint(20) NOT NULL AUTO_INCREMENT"),
+        ("CreatorServiceDescriptorGUID", "varchar(50) NOT NULL"),
+        ("CreatorLocalID", "bigint(20) NOT NULL"),
+        ("ParentServiceDescriptorGUID", "varchar(50) NOT NULL"),
+        ("ParentLocalID", "bigint(20) NOT NULL"),
+        ("Rating", "int(11) NOT NULL"),
+        ("RawBytes", "longblob NOT NULL"),
+        ("TestCaseType", "int(11) NOT NULL"),
+        ("TimeOfInsertion", "timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+    ],
+    "covered_blocks": [
+        ("ID", "bigint(20) NOT NULL AUTO_INCREMENT"),
+        ("CreatorTestcaseID", "bigint(20) NOT NULL"),
+        ("ModuleID", "int(11) NOT NULL"),
+        ("Offset", "bigint(20) NOT NULL"),
+        ("TimeOfInsertion", "timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+    ],
+    "edge_coverage": [
+        ("hash", "varchar(64) NOT NULL"),
+        ("counter", "bigint(20) NOT NULL"),
+    ],
+    "crash_descriptions": [
+        ("ID", "bigint(20) NOT NULL AUTO_INCREMENT"),
+        ("CreatorTestcaseID", "bigint(20) NOT NULL"),
+        ("CrashFootprint", "varchar(1000) NOT NULL"),
+    ],
+}
+
+
+# Simulated FLUFFI location: fluffiweb and Polemarch over HTTP, the databases in
+# SQLite, and agent processes that accrue CPU time on the worker
+class Sim:
+    def __init__(self, location, speedup=SPEEDUP):
+        self.location = location
+        self.speedup = speedup
+        self.lock = threading.RLock()
+        self.round_trips = collections.Counter()
+        self.random = random.Random(0)
+        self.dbs = {}
+        self.db(fluffi.DB_NAME).execute(
+            "CREATE TABLE fuzzjob (ID INTEGER PRIMARY KEY, name TEXT)"
+        )
+        self.lm = {}
+        self.gre = {}
+        self.cpu_time = {}
+        self.processes = {}
+        self.next_pid = 1000
+        self.archived = set()
+        self.history_id = 0
+        self.last_tick = time.time()
+
+        # Serve HTTP on an ephemeral port
+        handler = type("Handler", (Handler,), {"sim": self})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def db(self, name):
+        if name not in self.dbs:
+            self.dbs[name] = sqlite3.connect(
+                ":memory:", check_same_thread=False, isolation_level=None
+            )
+        return self.dbs[name]
+
+    # --- Simulation ---
+
+    def tick(self):
+        now = time.time()
+        elapsed = (now - self.last_tick) * self.speedup
+        self.last_tick = now
+        for pid, (owner, cpu_time) in self.processes.items():
+            self.processes[pid] = (owner, cpu_time + elapsed)
+            if owner in self.cpu_time:
+                self.cpu_time[owner] += elapsed
+        for name in self.gre:
+            self.grow(name)
+
+    # Fills the fuzzjob DB up to the coverage expected at its CPU time
+    def grow(self, name):
+        db = self.db(fuzzjob.DB_FUZZJOB_FMT.format(name))
+        progress = 1 - math.exp(-self.cpu_time[name] / GROWTH_TIME)
+        now = time.strftime(TIME_FMT)
+        testcase = db.execute("SELECT MAX(ID) FROM interesting_testcases").fetchone()[0]
+        blocks = db.execute("SELECT COUNT(*) FROM covered_blocks").fetchone()[0]
+        db.executemany(
+            "INSERT INTO covered_blocks VALUES (NULL, ?, ?, ?, ?)",
+            [
+                (testcase, MODULE_ID, self.random.randrange(1 << 24), now)
+                for _ in range(int(BLOCKS_MAX * progress) - blocks)
+            ],
+        )
+        paths = db.execute("SELECT COUNT(*) FROM edge_coverage").fetchone()[0]
+        db.executemany(
+            "INSERT OR IGNORE INTO edge_coverage VALUES (?, 1)",
+            [
+                (f"{self.random.getrandbits(64):016x}",)
+                for _ in range(int(PATHS_MAX * progress) - paths)
+            ],
+        )
+        crashes = db.execute("SELECT COUNT(*) FROM crash_descriptions").fetchone()[0]
+        db.executemany(
+            "INSERT INTO crash_descriptions VALUES (NULL, ?, ?)",
+            [
+                (testcase, f"{self.location}+0x{self.random.randrange(1 << 16):x}")
+                for _ in range(int(CRASHES_MAX * progress) - crashes)
+            ],
+        )
+
+    # Starts and kills agent processes to match the configuration
+    def manage(self):
+        wanted = collections.Counter(
+            {"lm": sum(self.lm.values()) * PROCESSES_PER_AGENT}
+        )
+        for name, gre in self.gre.items():
+            wanted[name] = sum(gre) * PROCESSES_PER_AGENT
+        running = collections.Counter(owner for owner, _ in self.processes.values())
+        for owner in set(wanted) | set(running):
+            for _ in range(wanted[owner] - running[owner]):
+                self.processes[self.next_pid] = (owner, 0.0)
+                self.next_pid += 1
+            for _ in range(running[owner] - wanted[owner]):
+                pid = next(pid for pid, (o, _) in self.processes.items() if o == owner)
+                del self.processes[pid]
+
+    def create_fuzzjob(self, name, seeds):
+        gm = self.db(fluffi.DB_NAME)
+        key = gm.execute("INSERT INTO fuzzjob VALUES (NULL, ?)", (name,)).lastrowid
+        db = self.db(fuzzjob.DB_FUZZJOB_FMT.format(name))
+        for table, columns in TABLES.items():
+            definitions = [column for column, _ in columns]
+            if "AUTO_INCREMENT" in columns[0][1]:
+                definitions[0] += " INTEGER PRIMARY KEY"
+            else:
+                definitions[0] += " PRIMARY KEY"
+            db.execute(f"CREATE TABLE {table} ({', '.join(definitions)})")
+        now = time.strftime(TIME_FMT)
+        db.executemany(
+            "INSERT INTO interesting_testcases VALUES (NULL, ?, ?, ?, ?, 0, ?, 0, ?)",
+            [("seed", i, "seed", i, b"", now) for i in range(max(seeds, 1))],
+        )
+        self.gre[name] = (0, 0, 0)
+        self.cpu_time[name] = 0.0
+        return key
+
+    def get_name(self, key):
+        return (
+            self.db(fluffi.DB_NAME)
+            .execute("SELECT name FROM fuzzjob WHERE ID = ?", (key,))
+            .fetchone()[0]
+        )
+
+    # --- HTTP ---
+
+    def handle(self, method, path, body):
+        with self.lock:
+            self.round_trips["http"] += 1
+            self.tick()
+            path = urllib.parse.urlsplit(path).path
+            fields = {
+                k.decode(): v.decode()
+                for k, v in re.findall(
+                    rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.DOTALL
+                )
+            }
+            if method == "GET" and path == "/":
+                return 200, "FLUFFI"
+            elif path == "/projects/createProject":
+                self.create_fuzzjob(
+                    fields["name"], body.count(b'name="filename"; filename=')
+                )
+                return 200, "Success!"
+            elif m := re.fullmatch(r"/projects/view/(\d+)", path):
+                return 200, self.view(self.get_name(int(m[1])))
+            elif m := re.fullmatch(r"/systems/configureSystemInstances/(.+)", path):
+                self.lm[m[1]] = int(fields["localManager_lm"])
+                return 200, "Success!"
+            elif m := re.fullmatch(r"/systems/configureFuzzjobInstances/(.+)", path):
+                self.gre[m[1]] = tuple(
+                    int(v)
+                    for k, v in fields.items()
+                    if re.fullmatch(r".+_t[gre]", k) is not None
+                )
+                return 200, "Success!"
+            elif m := re.fullmatch(r"/projects/archive/(\d+)", path):
+                name = self.get_name(int(m[1]))
+                self.db(fluffi.DB_NAME).execute(
+                    "DELETE FROM fuzzjob WHERE ID = ?", (int(m[1]),)
+                )
+                self.archived.add(name)
+                del self.gre[name]
+                return 200, "Step 0/4"
+            elif path == "/progressArchiveFuzzjob":
+                return 200, "Step 4/4"
+            elif re.fullmatch(r"/api/v2/project/1/periodic_task/\d+/execute/", path):
+                self.manage()
+                self.history_id += 1
+                return 201, json.dumps(
+                    {"detail": "Started at inventory 1.", "history_id": self.history_id}
+                )
+            elif re.fullmatch(r"/api/v2/project/1/history/\d+", path):
+                return 200, json.dumps({"status": "OK"})
+            return 404, "Not found"
+
+    def view(self, name):
+        db = self.db(fuzzjob.DB_FUZZJOB_FMT.format(name))
+        population = db.execute("SELECT COUNT(*) FROM interesting_testcases").fetchone()
+        crashes = db.execute("SELECT COUNT(*) FROM crash_descriptions").fetchone()
+        blocks = db.execute("SELECT COUNT(*) FROM covered_blocks").fetchone()
+        values = [
+            int(self.cpu_time[name] * EXECS_PER_CPU_SECOND),
+            f"{population[0]} / {population[0]}",
+            crashes[0],
+            crashes[0],
+            crashes[0],
+            crashes[0],
+            0,
+            0,
+            blocks[0],
+        ]
+        return "General Information\n" + "\n".join(
+            f'<td style="text-align: center;">{value}</td>' for value in values
+        )
+
+    # --- SSH ---
+
+    def exec_command(self, command):
+        with self.lock:
+            self.round_trips["ssh"] += 1
+            self.tick()
+            if command.startswith("ps --cumulative"):
+                return "\n".join(
+                    f"{pid} {int(cpu_time) // 60}:{int(cpu_time) % 60:02d}"
+                    for pid, (_, cpu_time) in self.processes.items()
+                )
+            elif "/proc/loadavg" in command:
+                return str(len(self.processes) / PROCESSES_PER_AGENT * 0.45)
+            elif command == "nproc":
+                return "16"
+            elif command.startswith("free"):
+                return "40.0"
+            elif command.startswith("df"):
+                return "30%"
+            elif command.startswith("ls "):
+                return "\n".join(
+                    os.path.basename(
+                        fuzzjob.DUMP_PATH_FMT.format(
+                            fuzzjob.DB_FUZZJOB_FMT.format(name)
+                        )
+                    )
+                    for name in self.archived
+                )
+            elif command.startswith("pkill"):
+                self.processes.clear()
+            return ""
+
+    def get(self, remote_path, local_path):
+        with self.lock:
+            self.round_trips["sftp"] += 1
+            db = self.db(os.path.basename(remote_path).split(".")[0])
+            write_dump(
+                local_path,
+                {table: db.execute(f"SELECT * FROM {table}") for table in TABLES},
+            )
+
+    # --- DB ---
+
+    def query(self, func_name, query, db_name):
+        with self.lock:
+            self.round_trips["sql"] += 1
+            self.tick()
+            return getattr(self.db(db_name).execute(query), func_name)()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    sim = None
+
+    def do_GET(self):
+        self.respond("GET", b"")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.respond("POST", self.rfile.read(length))
+
+    def respond(self, method, body):
+        status, text = self.sim.handle(method, self.path, body)
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+# Routes fluffiweb and Polemarch URLs to the simulated server
+class Adapter(requests.adapters.HTTPAdapter):
+    def __init__(self, port, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.port = port
+
+    def send(self, request, *args, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        request.url = url._replace(netloc=f"127.0.0.1:{self.port}").geturl()
+        return super().send(request, *args, **kwargs)
+
+
+class Output:
+    def __init__(self, data=b""):
+        self.data = data
+        self.channel = self
+
+    def read(self):
+        return self.data
+
+    def recv_exit_status(self):
+        return 0
+
+
+class SSHClient:
+    def __init__(self, sim):
+        self.sim = sim
+
+    def exec_command(self, command, check=False):
+        return None, Output(self.sim.exec_command(command).encode()), Output()
+
+    def get(self, remote_path, local_path):
+        self.sim.get(remote_path, local_path)
+
+    def put(self, local_path, remote_path):
+        with self.sim.lock:
+            self.sim.round_trips["sftp"] += 1
+
+
+class DBClient:
+    def __init__(self, sim):
+        self.sim = sim
+
+    def query_one(self, query, db_name):
+        return self.sim.query("fetchone", query, db_name)
+
+    def query_all(self, query, db_name):
+        return self.sim.query("fetchall", query, db_name)
+
+
+# Instance wired to a simulated location instead of the real servers
+class Instance(fluffi.Instance):
+    def __init__(self, n=5, speedup=SPEEDUP):
+        self.n = n
+        self.fluffi_path = fluffi.FLUFFI_PATH_FMT.format(self.n)
+        self.location = fluffi.LOCATION_FMT.format(self.n)
+        self.master_addr = "127.0.0.1"
+        self.agents_pending = False
+        self.cgroup = fluffi.CGROUP
+        self.sim = Sim(self.location, speedup)
+        self.ssh_host = SSHClient(self.sim)
+        self.ssh_master = SSHClient(self.sim)
+        self.workers = [fluffi.Worker(self.n, 1)]
+        self.workers[0].ssh = SSHClient(self.sim)
+        self.db = DBClient(self.sim)
+        self.s = self.new_session()
+        self.s.get(fluffi.FLUFFI_URL)
+
+    def new_session(self):
+        s = util.FaultTolerantSession(self)
+        s.trust_env = False
+        s.proxies.clear()
+        s.mount("http://", Adapter(self.sim.port))
+        return s
+
+
+# Writes a gzipped MySQL dump of the given tables, each an iterable of row tuples,
+# in alphabetical order like mysqldump
+def write_dump(path, tables, rows_per_insert=ROWS_PER_INSERT):
+    with gzip.open(path, "wt", encoding="utf-8", errors="surrogateescape") as f:
+        for table, rows in sorted(tables.items()):
+            columns = TABLES[table]
+            f.write(f"DROP TABLE IF EXISTS `{table}`;\n")
+            f.write(f"CREATE TABLE `{table}` (\n")
+            f.write(",\n".join(f"  `{name}` {sql_type}" for name, sql_type in columns))
+            f.write(f",\n  PRIMARY KEY (`{columns[0][0]}`)\n);\n")
+            values = []
+            for row in rows:
+                values.append("(" + ",".join(map(sql_value, row)) + ")")
+                if len(values) == rows_per_insert:
+                    f.write(f"INSERT INTO `{table}` VALUES {','.join(values)};\n")
+                    values = []
+            if len(values) > 0:
+                f.write(f"INSERT INTO `{table}` VALUES {','.join(values)};\n")
+
+
+def sql_value(value):
+    if value is None:
+        return "NULL"
+    elif isinstance(value, bytes):
+        return f"0x{value.hex()}" if len(value) > 0 else "''"
+    elif isinstance(value, str):
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+    return str(value)
+
+
+# Writes a synthetic trial dump and stats file, with table sizes multiplied by scale
+def write_synthetic_trial(benchmark_dir, trial, scale=1.0, seed=0):
+    rng = random.Random(seed)
+    rows = {table: int(n * scale) for table, n in SYNTHETIC_ROWS.items()}
+    start = time.time() - SYNTHETIC_REAL_TIME
+
+    # Timestamps are front loaded like real coverage growth
+    def timestamp(i, n):
+        return time.strftime(
+            TIME_FMT, time.localtime(start + SYNTHETIC_REAL_TIME * (i / n) ** 3)
+        )
+
+    testcases = rows["interesting_testcases"]
+    blocks = max(int(rows["covered_blocks"] * SYNTHETIC_BLOCK_RATIO), 1)
+    footprints = max(int(rows["crash_descriptions"] * SYNTHETIC_CRASH_RATIO), 1)
+    tables = {
+        "interesting_testcases": (
+            (
+                i,
+                "guid",
+                i,
+                "guid",
+                rng.randrange(1, i + 1),
+                rng.randrange(-10, 100),
+                rng.randbytes(rng.randrange(1, 2 * SYNTHETIC_TESTCASE_SIZE)),
+                0,
+                timestamp(i, testcases),
+            )
+            for i in range(1, testcases + 1)
+        ),
+        "covered_blocks": (
+            (
+                i,
+                rng.randrange(1, testcases + 1),
+                MODULE_ID,
+                rng.randrange(blocks) * 4,
+                timestamp(i, rows["covered_blocks"]),
+            )
+            for i in range(1, rows["covered_blocks"] + 1)
+        ),
+        "edge_coverage": (
+            (f"{rng.getrandbits(64):016x}", rng.randrange(1, 1000))
+            for _ in range(rows["edge_coverage"])
+        ),
+        "crash_descriptions": (
+            (
+                i,
+                rng.randrange(1, testcases + 1),
+                f"access violation at module+0x{rng.randrange(footprints) * 16:x}",
+            )
+            for i in range(1, rows["crash_descriptions"] + 1)
+        ),
+    }
+    write_dump(os.path.join(benchmark_dir, experiment.DUMP_FMT.format(trial)), tables)
+
+    # Stats sampled on every checkpoint
+    stats = []
+    for checkpoint in range(
+        experiment.GET_STATS_INTERVAL,
+        experiment.TRIAL_TIME + 1,
+        experiment.GET_STATS_INTERVAL,
+    ):
+        progress = 1 - math.exp(-checkpoint / GROWTH_TIME)
+        crashes = int(footprints * progress)
+        stats.append(
+            {
+                "completed_testcases": checkpoint * EXECS_PER_CPU_SECOND,
+                "population": int(testcases * progress),
+                "access_violations_total": crashes,
+                "access_violations_unique": crashes,
+                "crashes_total": crashes,
+                "crashes_unique": crashes,
+                "hangs": 0,
+                "no_response": 0,
+                "covered_blocks": int(blocks * progress),
+                "gen": fuzzjob.GEN_INIT,
+                "run": fuzzjob.RUN_INIT,
+                "eva": fuzzjob.EVA_INIT,
+                "paths": int(rows["edge_coverage"] * progress),
+                "load": rng.uniform(14, 16),
+                "memory_used": rng.uniform(30, 50),
+                "disk_used": 30,
+                "ramdisk_used": 20,
+                "cpu_time": checkpoint + rng.randrange(30),
+                "checkpoint": checkpoint,
+                "real_time": SYNTHETIC_REAL_TIME * checkpoint / experiment.TRIAL_TIME,
+            }
+        )
+    pd.DataFrame(stats).to_parquet(
+        os.path.join(benchmark_dir, experiment.DATA_FMT.format(trial))
+    )
+    return rows
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import logging
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Constants
+ARROW_TYPES = [
+    (re.compile(r"^bigint"), pa.int64(), pa.uint64()),
+    (re.compile(r"^tinyint"), pa.int8(), pa.uint8()),
+    (re.compile(r"^smallint"), pa.int16(), pa.uint16()),
+    (re.compile(r"^(?:mediumint|int|integer)\b"), pa.int32(), pa.uint32()),
+    (re.compile(r"^(?:float|double|real|decimal|numeric)"), pa.float64(), None),
+    (re.compile(r"^(?:timestamp|datetime)"), pa.timestamp("s"), None),
+    (re.compile(r"^date\b"), pa.date32(), None),
+    (re.compile(r"^(?:(?:tiny|medium|long)?blob|(?:var)?binary)"), pa.binary(), None),
+]
+QUOTED = rb"'(?:[^'\\]|\\.|'')*'"
+VALUE = rb"NULL|" + QUOTED + rb"|_binary " + QUOTED + rb"|0x[0-9A-Fa-f]*|[-+.0-9eE]+"
+CREATE_RE = re.compile(rb"CREATE TABLE `([^`]+)` \(")
+COLUMN_RE = re.compile(rb"\s*`([^`]+)` ([^ ,]+(?: unsigned)?)")
+INSERT_RE = re.compile(rb"INSERT INTO `([^`]+)` VALUES ")
+ESCAPE_RE = re.compile(rb"\\(.)|''", re.DOTALL)
+ESCAPES = {
+    b"0": b"\0",
+    b"b": b"\b",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"Z": b"\x1a",
+}
+
+# Get logger
+log = logging.getLogger("fluffi")
+
+
+def main():
+    # Setup logging
+    log.setLevel(logging.INFO)
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="gzipped MySQL dump")
+    parser.add_argument("out_dir", type=str, help="directory for the Parquet files")
+    parser.add_argument("-t", type=str, nargs="+", help="tables to convert (all)")
+    args = parser.parse_args()
+
+    # Convert and print row counts
+    for table, rows in convert(args.path, args.out_dir, args.t).items():
+        print(f"{table}: {rows} rows")
+
+
+# Schema of a dumped table, with a row pattern built from its columns that only
+# captures the selected ones. Counts the tuples the pattern rejected and the
+# values that could not be parsed as dates or times and were read as NULL.
+class Table:
+    def __init__(self, name, columns, selected=None):
+        self.name = name
+        self.columns = columns
+        self.rejected = 0
+        self.coerced = 0
+        self.selected = [
+            i
+            for i, (column, _) in enumerate(columns)
+            if selected is None or column in selected
+        ]
+        self.schema = pa.schema(
+            [(columns[i][0], arrow_type(columns[i][1])) for i in self.selected]
+        )
+        self.row_re = re.compile(
+            rb"\("
+            + rb",".join(
+                rb"(" + VALUE + rb")" if i in self.selected else rb"(?:" + VALUE + rb")"
+                for i in range(len(columns))
+            )
+            + rb"\)"
+        )
+
+    # Parses the tuples of one INSERT statement into a record batch
+    def parse(self, values):
+        rows = self.row_re.findall(values)
+        if values.count(b"),(") + 1 != len(rows):
+            self.rejected += self.count_rejected(values)
+        if len(self.selected) == 1:
+            rows = [(row,) for row in rows]
+        arrays = []
+        for i, field in enumerate(self.schema):
+            column = [row[i] for row in rows]
+            array = to_arrow(column, field.type)
+            if pa.types.is_temporal(field.type):
+                self.coerced += array.null_count - column.count(b"NULL")
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    # Only called when the tuple count is off, which strings holding "),(" also
+    # cause, so the text between matches is checked for skipped tuples
+    def count_rejected(self, values):
+        rejected = 0
+        pos = 0
+        for m in self.row_re.finditer(values):
+            rejected += count_tuples(values[pos : m.start()])
+            pos = m.end()
+        return rejected + count_tuples(values[pos:])
+
+    def warn(self):
+        if self.rejected > 0:
+            log.warning(f"Skipped {self.rejected} malformed rows of {self.name}")
+        if self.coerced > 0:
+            log.warning(
+                f"Read {self.coerced} malformed dates or times of {self.name} as NULL"
+            )
+
+
+def count_tuples(text):
+    text = text.strip(b",; \t")
+    return 0 if len(text) == 0 else text.count(b"),(") + 1
+
+
+def arrow_type(sql_type):
+    sql_type = sql_type.lower()
+    for pattern, signed, unsigned in ARROW_TYPES:
+        if pattern.search(sql_type):
+            return unsigned if "unsigned" in sql_type and unsigned else signed
+    return pa.string()
+
+
+# Numbers are cast by Arrow, quoted values are unescaped first
+def to_arrow(values, arrow_type):
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+        array = pa.array(values, pa.binary()).cast(pa.string())
+        array = pc.if_else(pc.equal(array, "NULL"), None, array)
+        return array.cast(arrow_type)
+    values = [unquote(value) for value in values]
+    if pa.types.is_binary(arrow_type):
+        return pa.array(values, pa.binary())
+    array = pa.array(
+        [
+            None if value is None else value.decode("utf-8", "replace")
+            for value in values
+        ],
+        pa.string(),
+    )
+    if pa.types.is_timestamp(arrow_type):
+        return pc.strptime(
+            array, format="%Y-%m-%d %H:%M:%S", unit="s", error_is_null=True
+        )
+    elif pa.types.is_date(arrow_type):
+        return pc.strptime(array, format="%Y-%m-%d", unit="s", error_is_null=True).cast(
+            arrow_type
+        )
+    return array
+
+
+def unquote(value):
+    if value == b"NULL":
+        return None
+    elif value.startswith(b"0x"):
+        return bytes.fromhex(value[2:].decode())
+    elif value.startswith(b"_binary "):
+        value = value[8:]
+    value = value[1:-1]
+    if b"\\" in value or b"''" in value:
+        value = ESCAPE_RE.sub(
+            lambda m: b"'" if m[1] is None else ESCAPES.get(m[1], m[1]), value
+        )
+    return value
+
+
+# Yields (table, record batch) for each INSERT statement of the selected tables,
+# which map to the columns to keep or None for all of them
+def iter_batches(lines, tables=None):
+    schemas = {}
+    create = None
+    for line in lines:
+        line = line.rstrip(b"\r\n")
+
+        # Collect column definitions until the end of a CREATE TABLE
+        if create is not None:
+            m = COLUMN_RE.match(line)
+            if m is not None:
+                create[1].append((m[1].decode(), m[2].decode()))
+                continue
+            elif not line.startswith(b")"):
+                continue
+            name, columns = create
+            create = None
+            if tables is None or name in tables:
+                selected = None if tables is None else tables[name]
+                schemas[name] = Table(name, columns, selected)
+        elif m := CREATE_RE.match(line):
+            create = (m[1].decode(), [])
+        elif m := INSERT_RE.match(line):
+            name = m[1].decode()
+            if name in schemas:
+                yield name, schemas[name].parse(line[m.end() :])
+    for table in schemas.values():
+        table.warn()
+
+
+# Reads the selected tables of a dump into Arrow tables, leaving out tables
+# without any rows
+def read_tables(lines, tables=None):
+    if tables is not None and not isinstance(tables, dict):
+        tables = {table: None for table in tables}
+    batches = {}
+    for name, batch in iter_batches(lines, tables):
+        batches.setdefault(name, []).append(batch)
+    return {name: pa.Table.from_batches(batches[name]) for name in batches}
+
+
+def open_dump(path):
+    return gzip.open(path, "rb")
+
+
+# Writes each selected table of a dump to {table}.parquet, returning row counts
+def convert(path, out_dir, tables=None):
+    if tables is not None and not isinstance(tables, dict):
+        tables = {table: None for table in tables}
+    os.makedirs(out_dir, exist_ok=True)
+    writers = {}
+    rows = {}
+    with open_dump(path) as f:
+        for name, batch in iter_batches(f, tables):
+            if name not in writers:
+                writers[name] = pq.ParquetWriter(
+                    os.path.join(out_dir, f"{name}.parquet"), batch.schema
+                )
+                rows[name] = 0
+            writers[name].write_batch(batch)
+            rows[name] += batch.num_rows
+    for writer in writers.values():
+        writer.close()
+    log.info(f"Converted {sum(rows.values())} rows from {path}")
+    return rows
+
+
+if __name__ == "__main__":
+    main()
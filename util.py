@@ -1,13 +1,20 @@
+import functools
 import logging
 import os
+import socket
 import time
 
 import paramiko
 import pymysql
 import requests
+import urllib3
+
+import replay
 
 # Constants
+HTTP_VIA = "tunnel"  # "tunnel" or "socks"
 PROXY_PORT = 6969
+PROXY_TIMEOUT = 2
 FLUFFI_DB_ERROR_STR = "Error: Database connection failed"
 SLEEP_TIME = 0.25
 SLEEP_TIME_MULTIPLIER = 2
@@ -17,14 +24,29 @@ REQ_TRIES = 3
 # Get logger
 log = logging.getLogger("fluffi")
 
-# Get SSH config
-ssh_config = paramiko.SSHConfig()
-with open(os.path.expanduser("~/.ssh/config")) as f:
-    ssh_config.parse(f)
+
+# Parses the SSH config on first use
+@functools.lru_cache(maxsize=None)
+def get_ssh_config():
+    ssh_config = paramiko.SSHConfig()
+    with open(os.path.expanduser("~/.ssh/config")) as f:
+        ssh_config.parse(f)
+    return ssh_config
 
 
 def get_ssh_addr(hostname):
-    return ssh_config.lookup(hostname)["hostname"]
+    return get_ssh_config().lookup(hostname)["hostname"]
+
+
+# Checks that a SOCKS5 proxy accepts a no-auth handshake
+def check_socks_proxy(addr, port=PROXY_PORT):
+    try:
+        with socket.create_connection((addr, port), timeout=PROXY_TIMEOUT) as sock:
+            sock.sendall(b"\x05\x01\x00")
+            return sock.recv(2) == b"\x05\x00"
+    except OSError as e:
+        log.debug(f"Proxy at {addr}:{port} not healthy: {e}")
+        return False
 
 
 def get_sleep_time(sleep_time):
@@ -35,13 +57,26 @@ class FaultTolerantSession(requests.Session):
     def __init__(self, fluffi, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fluffi = fluffi
-        proxies = {
-            "http": f"socks5h://{fluffi.master_addr}:{PROXY_PORT}",
-            "https": f"socks5h://{fluffi.master_addr}:{PROXY_PORT}",
-        }
-        self.proxies.update(proxies)
+        if HTTP_VIA == "tunnel":
+            self.trust_env = False
+            self.mount("http://", SSHTunnelAdapter(fluffi.ssh_master))
+        else:
+            proxies = {
+                "http": f"socks5h://{fluffi.master_addr}:{PROXY_PORT}",
+                "https": f"socks5h://{fluffi.master_addr}:{PROXY_PORT}",
+            }
+            self.proxies.update(proxies)
 
     def request(self, *args, **kwargs):
+        return replay.call(
+            "http",
+            {"method": args[0], "url": args[1]},
+            lambda: self.__request(*args, **kwargs),
+            replay.dump_response,
+            replay.load_response,
+        )
+
+    def __request(self, *args, **kwargs):
         url = args[1]
         expect_str = kwargs.pop("expect_str", None)
         no_retry = kwargs.pop("no_retry", False)
@@ -71,28 +106,66 @@ class FaultTolerantSession(requests.Session):
                 f"Request for '{url}' failed {REQ_TRIES} times, "
                 "checking proxy and restarting fluffiweb"
             )
-            self.fluffi.check_proxy()
+            if HTTP_VIA == "socks":
+                self.fluffi.check_proxy()
             self.fluffi.ssh_master.exec_command(
                 "cd /srv/fluffi/ && sudo docker-compose restart fluffiweb", check=True
             )
             time.sleep(5)
 
 
+# HTTP connection over a direct-tcpip channel, resolved and opened by the SSH server
+class SSHTunnelConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, *args, ssh=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ssh = ssh
+
+    def _new_conn(self):
+        channel = self.ssh.open_tunnel((self.host, self.port))
+        channel.settimeout(self.timeout)
+        return channel
+
+
+class SSHTunnelConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = SSHTunnelConnection
+
+    def __init__(self, *args, ssh=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.conn_kw["ssh"] = ssh
+
+
+# Carries a session's HTTP requests over the SSH transport to a host, keeping
+# connections alive in the adapter's pools like the default adapter
+class SSHTunnelAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, ssh, *args, **kwargs):
+        self.ssh = ssh
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": functools.partial(SSHTunnelConnectionPool, ssh=self.ssh)
+        }
+
+
 class FaultTolerantSSHAndSFTPClient:
     def __init__(self, hostname):
         self.hostname = hostname
-        host_config = ssh_config.lookup(self.hostname)
+        host_config = get_ssh_config().lookup(self.hostname)
         self.host_config = {
             "hostname": host_config["hostname"],
             "username": host_config["user"],
             "key_filename": host_config["identityfile"],
         }
-        self.__connect(False)
+        self.ssh = None
+        self.sftp = None
 
     def __del__(self):
         self.__close()
 
     def __close(self):
+        if self.ssh is None:
+            return
         log.debug(f"Closing SSH/SFTP for {self.hostname}")
         try:
             self.sftp.close()
@@ -101,9 +174,8 @@ class FaultTolerantSSHAndSFTPClient:
             log.error(f"Error closing SSH/SFTP for {self.hostname}: {e}")
         log.debug(f"SSH/SFTP closed for {self.hostname}")
 
-    def __connect(self, reconnect=True):
-        if reconnect:
-            self.__close()
+    def __connect(self):
+        self.__close()
         sleep_time = SLEEP_TIME
         while True:
             log.debug(f"Connecting to SSH/SFTP for {self.hostname}...")
@@ -119,7 +191,13 @@ class FaultTolerantSSHAndSFTPClient:
             sleep_time = get_sleep_time(sleep_time)
         log.debug(f"Connected to SSH/SFTP for {self.hostname}")
 
+    # Connects on first use
+    def __ensure_connected(self):
+        if self.ssh is None:
+            self.__connect()
+
     def __sftp(self, func_name, *args, **kwargs):
+        self.__ensure_connected()
         sleep_time = SLEEP_TIME
         while True:
             try:
@@ -131,7 +209,17 @@ class FaultTolerantSSHAndSFTPClient:
             sleep_time = get_sleep_time(sleep_time)
 
     def exec_command(self, *args, **kwargs):
+        return replay.call(
+            "ssh",
+            {"host": self.hostname, "command": args[0]},
+            lambda: self.__exec_command(*args, **kwargs),
+            replay.dump_output,
+            replay.load_output,
+        )
+
+    def __exec_command(self, *args, **kwargs):
         check = kwargs.pop("check", False)
+        self.__ensure_connected()
         sleep_time = SLEEP_TIME
         while True:
             try:
@@ -152,20 +240,51 @@ class FaultTolerantSSHAndSFTPClient:
             time.sleep(sleep_time)
             sleep_time = get_sleep_time(sleep_time)
 
-    def get(self, *args, **kwargs):
-        return self.__sftp("get", *args, **kwargs)
+    def open_tunnel(self, addr):
+        self.__ensure_connected()
+        sleep_time = SLEEP_TIME
+        while True:
+            try:
+                return self.ssh.get_transport().open_channel(
+                    "direct-tcpip", addr, ("127.0.0.1", 0)
+                )
+            except paramiko.ChannelException as e:
+                log.error(f"Tunnel from {self.hostname} to {addr} refused: {e}")
+                raise ConnectionError(e)
+            except Exception as e:
+                log.error(f"Error opening tunnel from {self.hostname} to {addr}: {e}")
+                self.__connect()
+            time.sleep(sleep_time)
+            sleep_time = get_sleep_time(sleep_time)
 
-    def put(self, *args, **kwargs):
-        return self.__sftp("put", *args, **kwargs)
+    def get(self, remote_path, local_path):
+        return replay.call(
+            "sftp_get",
+            {"host": self.hostname, "path": remote_path},
+            lambda: self.__sftp("get", remote_path, local_path),
+            lambda _: replay.dump_file(local_path),
+            lambda size: replay.load_file(local_path, size),
+        )
+
+    def put(self, local_path, remote_path):
+        return replay.call(
+            "sftp_put",
+            {"host": self.hostname, "path": remote_path},
+            lambda: self.__sftp("put", local_path, remote_path),
+            lambda _: replay.dump_file(local_path),
+            lambda _: None,
+        )
 
 
 class FaultTolerantDBClient(pymysql.Connection):
     def __init__(self, *args, **kwargs):
         kwargs["autocommit"] = True
+        kwargs["defer_connect"] = True
         super().__init__(*args, **kwargs)
-        self.__connect()
 
     def __del__(self):
+        if not self.open:
+            return
         log.debug("Closing DB...")
         self.close()
         log.debug("DB closed")
@@ -184,6 +303,8 @@ class FaultTolerantDBClient(pymysql.Connection):
             sleep_time = get_sleep_time(sleep_time)
 
     def __query(self, func_name, query, db_name):
+        if not self.open:
+            self.__connect()
         sleep_time = SLEEP_TIME
         while True:
             try:
@@ -198,7 +319,19 @@ class FaultTolerantDBClient(pymysql.Connection):
             sleep_time = get_sleep_time(sleep_time)
 
     def query_one(self, query, db_name):
-        return self.__query("fetchone", query, db_name)
+        return replay.call(
+            "sql",
+            {"db": db_name, "query": query},
+            lambda: self.__query("fetchone", query, db_name),
+            lambda row: row,
+            replay.load_row,
+        )
 
     def query_all(self, query, db_name):
-        return self.__query("fetchall", query, db_name)
+        return replay.call(
+            "sql",
+            {"db": db_name, "query": query},
+            lambda: self.__query("fetchall", query, db_name),
+            lambda rows: rows,
+            replay.load_rows,
+        )